@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# sshgo 的性能测试脚本，用法: python bench.py <benchmark> [options]
+#   memory   对比旧的dict节点和 __slots__ 节点(HostNode/GroupNode)的内存占用和遍历速度
+#   startup  对比启动界面到首帧 和 命令行直接列出/登录主机(不初始化curses) 的耗时
+#   record   会话录像(--record)打开和关闭时会话输出路径的吞吐量，以及关闭录像时等写录像线程写完的时间
+#   ui       不启动终端，用假的curses屏幕驱动 SSHGO: 各个操作(get_lines/_search_node/render_screen/updown...)
+#            的耗时和内存，以及按一串脚本化的按键走一遍主循环时每种按键的耗时
+#   login    do_ssh 对着 fake_ssh.py (按指定延迟给出主机公钥确认、密码和shell提示符)登录，统计expect各步骤的耗时
+# ui 和 login 可以用 --save-baseline 保存结果，之后用 --baseline 对比，变慢超过 --tolerance 时返回1。
+# 基线里的耗时是相对同一次运行里校准操作的倍数，换一台机器也能对比
+
+import os
+import sys
+import json
+import time
+import statistics
+import tempfile
+import tracemalloc
+from optparse import OptionParser
+
+import sshgo
+
+
+# 生成测试用的配置: depth层分组，每组fanout个子组，最底层的组里平均分配hosts台主机
+def make_inventory(hosts, depth=2, fanout=10, expect=True):
+    counter = [0, 0]
+
+    def make_hosts(count):
+        rt = []
+        for i in range(count):
+            counter[0] += 1
+            n = counter[0]
+            host = {'title': 'host-%d' % n,
+                    'ssh': 'root@10.%d.%d.%d -p 22' % (n >> 16 & 255, n >> 8 & 255, n & 255)}
+            if expect:
+                host['expect'] = [{'passwd': 'secret-%d' % n}]
+            rt.append(host)
+        return rt
+
+    def make_groups(level, count):
+        rt = []
+        for i in range(fanout):
+            counter[1] += 1
+            share = count // fanout + (1 if i < count % fanout else 0)
+            group = {'title': 'group-%d' % counter[1]}
+            if level == depth:
+                group['sub_node'] = make_hosts(share)
+            else:
+                group['sub_node'] = make_groups(level + 1, share)
+            rt.append(group)
+        return rt
+
+    if depth <= 0:
+        return make_hosts(hosts)
+    return make_groups(1, hosts)
+
+
+def write_inventory(path, hosts, depth, fanout, expect=True):
+    with open(path, 'w') as f:
+        json.dump(make_inventory(hosts, depth, fanout, expect), f)
+
+
+# 不初始化curses，只加载配置
+def load_headless(config_file, use_cache=False):
+    app = SSHGO_HEADLESS.__new__(SSHGO_HEADLESS)
+    app.use_cache = use_cache
+    app.startup_profile = []
+    app._profile_time = time.perf_counter()
+    app.top_line_number = 0
+    app.highlight_line_number = 0
+    app._parse_config_file(config_file)
+    return app
+
+
+class SSHGO_HEADLESS(sshgo.SSHGO):
+    def __del__(self):
+        pass
+
+
+# 旧版本 handle_node 的做法: 直接在json解析出来的dict上添加字段
+def legacy_handle_node(parent, nodes, level, counter):
+    for anode in nodes:
+        counter[0] += 1
+        if 'sub_node' not in anode:
+            anode['sub_node'] = []
+        if 'expanded' not in anode:
+            anode['expanded'] = False
+        if 'expect' not in anode:
+            anode['expect'] = []
+        anode['parent'] = parent
+        anode['level'] = level
+        anode['line_number'] = counter[0]
+        if len(anode['sub_node']):
+            legacy_handle_node(anode, anode['sub_node'], level + 1, counter)
+
+
+def walk_dict(config):
+    count = 0
+    stack = list(config)
+    while len(stack):
+        node = stack.pop()
+        if 'expanded' in node and node['expanded'] is None:
+            count += 1
+        if len(node['sub_node']):
+            stack.extend(node['sub_node'])
+    return count
+
+
+def walk_slots(config):
+    count = 0
+    stack = list(config)
+    while len(stack):
+        node = stack.pop()
+        if node.expanded is None:
+            count += 1
+        if len(node.sub_node):
+            stack.extend(node.sub_node)
+    return count
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def time_walk(walk, config, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        walk(config)
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_memory(options):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = os.path.join(tmp_dir, 'ssh_hosts.json')
+        write_inventory(config_file, options.hosts, options.depth, options.fanout)
+
+        def build_dict():
+            with open(config_file) as f:
+                config = json.load(f)
+            legacy_handle_node(None, config, 0, [0])
+            return config
+
+        dict_config, dict_current, dict_peak, dict_load = measure(build_dict)
+        app, slots_current, slots_peak, slots_load = measure(lambda: load_headless(config_file))
+
+        dict_walk = time_walk(walk_dict, dict_config, options.repeat)
+        slots_walk = time_walk(walk_slots, app.config, options.repeat)
+
+    print('nodes: %d hosts, depth %d, fanout %d' % (options.hosts, options.depth, options.fanout))
+    print('%-8s %12s %12s %10s %10s' % ('model', 'resident', 'peak', 'load', 'walk'))
+    for name, current, peak, load, walk in (('dict', dict_current, dict_peak, dict_load, dict_walk),
+                                            ('slots', slots_current, slots_peak, slots_load, slots_walk)):
+        print('%-8s %9.1f MB %9.1f MB %7.1f ms %7.2f ms' % (name, current / 1048576.0, peak / 1048576.0,
+                                                          load * 1000, walk * 1000))
+    print('resident memory: %.1f%% of dict model' % (100.0 * slots_current / dict_current))
+
+
+# 在伪终端里启动 sshgo.py，返回从启动到出现 until 的耗时
+def time_launch(args, env, until):
+    import pexpect
+    start = time.perf_counter()
+    child = pexpect.spawn(args[0], args[1:], env=env, encoding='utf-8', dimensions=(40, 120))
+    child.expect(until, timeout=30)
+    elapsed = time.perf_counter() - start
+    if until is not pexpect.EOF:
+        child.send('q')
+        child.expect(pexpect.EOF, timeout=30)
+    child.close()
+    return elapsed
+
+
+def bench_startup(options):
+    import pexpect
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sshgo.py')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = os.path.join(tmp_dir, 'ssh_hosts.json')
+        # 主机不配置expect，ssh命令用true代替，登录路径测到启动ssh为止
+        write_inventory(config_file, options.hosts, options.depth, options.fanout, expect=False)
+        env = dict(os.environ, HOME=tmp_dir, XDG_CACHE_HOME=os.path.join(tmp_dir, 'cache'), TERM='xterm')
+        base = [sys.executable, script, '-c', config_file, '--no-multiplex', '--ssh-command', 'true']
+        cases = (('tui first frame', base, r'group-1\('),
+                 ('--list title', base + ['--list', 'host-1'], pexpect.EOF),
+                 ('--json pattern', base + ['--json', 'host-12'], pexpect.EOF),
+                 ('connect title', base + ['host-1'], pexpect.EOF))
+        time_launch(base + ['--list'], env, pexpect.EOF)  # 先生成编译缓存，下面都是命中缓存的启动
+        print('nodes: %d hosts, depth %d, fanout %d, %d runs each' % (options.hosts, options.depth, options.fanout,
+                                                                     options.repeat))
+        print('%-16s %10s %10s %10s' % ('path', 'min', 'median', 'max'))
+        for name, args, until in cases:
+            samples = sorted(time_launch(args, env, until) for i in range(options.repeat))
+            print('%-16s %7.1f ms %7.1f ms %7.1f ms' % (name, samples[0] * 1000, samples[len(samples) // 2] * 1000,
+                                                         samples[-1] * 1000))
+
+
+# 模拟日志输出: 带时间戳和少量中文的行
+def make_log(size):
+    line = '2024-05-01 12:00:00,123 INFO  [worker-%d] request done status=200 耗时=%dms path=/api/v1/items\r\n'
+    chunks = []
+    total = 0
+    i = 0
+    while total < size:
+        chunk = (line % (i % 64, i % 1000)).encode('utf-8')
+        chunks.append(chunk)
+        total += len(chunk)
+        i += 1
+    return b''.join(chunks)[:size]
+
+
+# 和 SSHGO._interact 一样: 从pty读出来，经过 Session.record 后写到终端(这里是/dev/null)
+def copy_session(session, out_fd):
+    total = 0
+    while True:
+        try:
+            data = os.read(session.child.child_fd, 65536)
+        except OSError:  # EIO: 子进程已经退出
+            break
+        if not data:
+            break
+        os.write(out_fd, session.record(data))
+        total += len(data)
+    return total
+
+
+def bench_record(options):
+    import pexpect
+    size = options.megabytes << 20
+    log = make_log(size)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_file = os.path.join(tmp_dir, 'session.log')
+        with open(log_file, 'wb') as f:
+            f.write(log)
+        out_fd = os.open(os.devnull, os.O_WRONLY)
+        for recording in (False, True):
+            def new_session(child):
+                recorder = None
+                if recording:
+                    recorder = sshgo.TranscriptRecorder(os.path.join(tmp_dir, 'casts'), 'bench', 1 << 30, 1)
+                return sshgo.Session(None, child, recorder)
+
+            # Session.record 本身: 按1000字节一块直接喂数据
+            session = new_session(None)
+            start = time.perf_counter()
+            for i in range(0, size, 1000):
+                session.record(log[i:i + 1000])
+            filter_time = time.perf_counter() - start
+            if session.recorder is not None:
+                session.recorder.close()
+
+            # 完整的pty路径: cat 一个日志文件，像 _interact 一样复制到终端
+            samples = []
+            close_samples = [0]
+            for i in range(options.repeat):
+                child = pexpect.spawn('cat', [log_file])
+                session = new_session(child)
+                start = time.perf_counter()
+                copied = copy_session(session, out_fd)
+                samples.append(time.perf_counter() - start)
+                if session.recorder is not None:
+                    start = time.perf_counter()
+                    session.recorder.close()
+                    close_samples.append(time.perf_counter() - start)
+                child.close()
+            results.append(('on' if recording else 'off', filter_time, min(samples), max(close_samples), copied))
+        os.close(out_fd)
+    print('%d MB of log output, record() fed 1000-byte chunks, best of %d pty runs (%d CPUs)' % (
+        options.megabytes, options.repeat, os.cpu_count()))
+    print('%-10s %14s %14s %12s' % ('recording', 'record()', 'pty', 'max close'))
+    for name, filter_time, pty_time, close_time, copied in results:
+        print('%-10s %9.1f MB/s %9.1f MB/s %9.1f ms' % (name, size / filter_time / 1048576.0,
+                                                       copied / pty_time / 1048576.0, close_time * 1000))
+
+
+# 替换 sshgo 模块里的 curses: 常量和按键码用真的，初始化、颜色和终端大小这些需要终端的函数换成空操作
+class FakeCurses:
+    def __init__(self, screen):
+        self.screen = screen
+
+    def __getattr__(self, name):
+        return getattr(sshgo_curses, name)
+
+    def initscr(self):
+        return self.screen
+
+    def tigetnum(self, name):
+        return self.screen.lines if name == 'lines' else self.screen.cols
+
+    def color_pair(self, n):
+        return n << 8
+
+    def isendwin(self):
+        return False
+
+    def noop(self, *args):
+        return None
+
+    noecho = cbreak = nocbreak = echo = endwin = curs_set = start_color = use_default_colors = init_pair = noop
+    doupdate = noop
+
+
+# 假的curses窗口: 只统计写了多少字符。getch/get_wch 依次返回脚本里的按键，并把两次取按键之间的耗时记到上一个按键上
+class FakeScreen:
+    KEY_NAMES = {'\n': 'Enter', '\x1b': 'Esc', ' ': 'Space', '\t': 'Tab', '\x7f': 'Backspace'}
+
+    def __init__(self, lines=40, cols=120, keys=()):
+        self.lines = lines
+        self.cols = cols
+        self.keys = list(reversed(keys))
+        self.cells = 0
+        self.timings = {}  # 按键名 -> [耗时秒数...]
+        self._last = None  # (按键名, 取到按键的时间)
+
+    def _next_key(self, search):
+        now = time.perf_counter()
+        if self._last is not None:
+            self.timings.setdefault(self._last[0], []).append(now - self._last[1])
+        key = self.keys.pop() if len(self.keys) else 'q'  # 脚本结束后退出主循环
+        name = self.KEY_NAMES.get(key, 'typing' if search else key)  # 搜索框里输入的字符合在一起统计
+        self._last = ('search ' + name if search else name, time.perf_counter())
+        return key
+
+    def getch(self):
+        return ord(self._next_key(False))
+
+    def get_wch(self):
+        return self._next_key(True)
+
+    def addstr(self, row, col, text, attr=0):
+        self.cells += len(text)
+
+    insstr = addstr
+
+    def subwin(self, lines, cols, row, col):
+        return FakeScreen(lines, cols)
+
+    def noop(self, *args):
+        return None
+
+    move = clrtoeol = refresh = noutrefresh = clear = border = keypad = timeout = noop
+
+
+sshgo_curses = sshgo.curses
+
+
+def headless_app(config_file, screen, multiplex=False, recent_size=0):
+    sshgo.curses = FakeCurses(screen)
+    app = SSHGO_HEADLESS(config_file, use_cache=False, multiplex=multiplex, recent_size=recent_size)
+    app.reload_interval = 0
+    app.screen = screen
+    for name, pair in (('COLOR_HIGHLIGHT', 2), ('COLOR_RED', 3), ('COLOR_RED_HIGH', 4), ('COLOR_WBG', 5),
+                       ('COLOR_BBG', 6)):
+        setattr(app, name, pair)
+    return app
+
+
+# 每次执行 op 的耗时(秒)列表，prepare 在每次执行前调用，不计时
+def time_op(op, repeat, prepare=None):
+    samples = []
+    for i in range(repeat):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        op()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def print_samples(rows):
+    print('%-28s %7s %10s %10s %10s' % ('operation', 'count', 'median', 'mean', 'max'))
+    for name, samples in rows:
+        print('%-28s %7d %7.3f ms %7.3f ms %7.3f ms' % (name, len(samples), statistics.median(samples) * 1000,
+                                                     statistics.mean(samples) * 1000, max(samples) * 1000))
+
+
+# 脚本化的按键: 展开全部、逐行和翻页移动、跳到首尾、切换分组、三种模式的搜索，最后折叠全部
+def ui_script():
+    return (['O'] + ['j'] * 300 + ['d'] * 30 + ['u'] * 30 + ['G', 'g'] + ['='] * 10 + ['-'] * 10 + ['C'] +
+            ['/'] + list('host-12') + ['\n'] + ['j'] * 50 + ['\x1b'] +
+            ['/', '\t'] + list('st-12') + ['\x7f'] * 3 + ['\n', '\x1b'] +
+            ['/', '\t', '\t'] + list('h12g') + ['\n', '\x1b'] +
+            ['O', 'G', 'C', 'q'])
+
+
+def bench_ui(options):
+    rows = []
+    metrics = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = os.path.join(tmp_dir, 'ssh_hosts.json')
+        write_inventory(config_file, options.hosts, options.depth, options.fanout)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(tmp_dir, 'cache')
+        # 和默认启动一样打开连接复用和recent组，recent组里放几台用过的主机
+        recent_size = sshgo.SSHGO.recent_size
+        usage = sshgo.UsageCache(os.path.join(sshgo.cache_dir(), 'recent.json'))
+        for n in range(recent_size):
+            usage.touch('host-%d' % (n * 97 + 1))
+        screen = FakeScreen(options.lines, options.cols)
+        try:
+            app, current, peak, load_time = measure(
+                lambda: headless_app(config_file, screen, multiplex=True, recent_size=recent_size))
+            metrics['memory resident MB'] = current / 1048576.0
+            metrics['memory peak MB'] = peak / 1048576.0
+            rows.append(('load', [load_time]))
+            rows.append(('open_all', time_op(app.open_all, options.repeat, app.close_all)))
+            rows.append(('close_all', time_op(app.close_all, options.repeat, app.open_all)))
+            app.open_all()
+            rows.append(('get_lines', time_op(app.get_lines, options.repeat * 100)))
+            rows.append(('render_screen full', time_op(app.render_screen, options.repeat, app.invalidate_screen)))
+            rows.append(('render_screen unchanged', time_op(app.render_screen, options.repeat)))
+
+            def step():
+                app.updown(1)
+                app.render_screen()
+            rows.append(('updown + render', time_op(step, options.repeat * 10)))
+
+            def page():
+                app.page(app.DOWN)
+                app.render_screen()
+            rows.append(('page + render', time_op(page, options.repeat)))
+
+            app.search_keyword = 'host-1'
+            rows.append(('search index build', time_op(app._search_node, 1)))
+            app._trigram_thread.join()  # 后台建立的三元组索引，下面单独计时
+            app.search_mode = 'substring'
+            rows.append(('trigram index build', time_op(app._build_trigram_index, 1)))
+            for mode, keyword in (('regex', 'host-12'), ('regex', 'host-1.*5$'), ('substring', 'st-12'),
+                                  ('fuzzy', 'h12g')):
+                app.search_mode = mode
+                app.search_keyword = keyword
+
+                def reset():
+                    app._search_cache = None
+                rows.append(('_search_node %s %s' % (mode, keyword), time_op(app._search_node, options.repeat, reset)))
+
+            # 主循环: 每种按键从取到按键到下一次取按键(处理+重绘)的耗时。再走一遍统计内存，tracemalloc 会拖慢计时
+            script = ui_script()
+            for traced in (False, True):
+                app.search_keyword = None
+                app.search_mode = 'regex'
+                app.close_all()
+                app.page_top()
+                screen.keys = list(reversed(script))
+                if traced:
+                    screen.timings = {}
+                    tracemalloc.start()
+                    app.run()
+                    script_peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                else:
+                    frames = app.render_stats['frames']
+                    start = time.perf_counter()
+                    app.run()
+                    script_time = time.perf_counter() - start
+                    frames = app.render_stats['frames'] - frames
+                    key_timings = screen.timings
+        finally:
+            sshgo.curses = sshgo_curses
+    print('nodes: %d hosts, depth %d, fanout %d, screen %dx%d, multiplex on, %d recent hosts'
+          % (options.hosts, options.depth, options.fanout, options.lines, options.cols, recent_size))
+    print('memory: %.1f MB resident after load, %.1f MB peak while loading, %.1f MB peak during the key script'
+          % (metrics['memory resident MB'], metrics['memory peak MB'], script_peak / 1048576.0))
+    print_samples(rows)
+    print()
+    print('key script: %d keys in %.1f ms, %d frames' % (len(script), script_time * 1000, frames))
+    key_rows = [('key ' + name, samples) for name, samples in sorted(key_timings.items())]
+    print_samples(key_rows)
+    for name, samples in rows + key_rows:
+        metrics[name] = statistics.median(samples) * 1000
+    metrics['memory script peak MB'] = script_peak / 1048576.0
+    return metrics
+
+
+# 登录场景: (名字, 主机配置列表, 目标主机, fake_ssh 给出的提示数)，每个提示前 fake_ssh 等待 --delay 秒
+def login_scenarios(delay):
+    args = '--delay %g' % delay
+    return (
+        ('password', [{'title': 'direct', 'ssh': args + ' root@direct', 'expect': [{'passwd': 'pw'}]}], 'direct', 2),
+        ('host key + password', [{'title': 'new', 'ssh': args + ' --host-key root@new',
+                                  'expect': [{'passwd': 'pw'}]}], 'new', 3),
+        ('long motd + ps1', [{'title': 'motd', 'ssh': args + ' --motd 5000 root@motd',
+                              'expect': [{'passwd': 'pw'}, {'ps1': ''}]}], 'motd', 2),
+        ('jump host', [{'title': 'jump', 'ssh': args + ' root@jump', 'expect': [{'passwd': 'pw'}]},
+                       {'title': 'inner', 'pre_host': 'jump',
+                        'expect': [{'# ': 'ssh admin@inner'}, {'passwd': 'pw'}, {'setTitle': ''}]}], 'inner', 4),
+    )
+
+
+def read_logins(cache_home):
+    path = os.path.join(cache_home, 'sshgo', 'logins.jsonl')
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# 在伪终端里用 sshgo.py title 登录，登录记录写进 logins.jsonl 时 do_ssh 的expect循环已经结束，然后退出所有shell
+def run_login(args, env, cache_home):
+    import pexpect
+    count = len(read_logins(cache_home))
+    child = pexpect.spawn(args[0], args[1:], env=env, encoding='utf-8', dimensions=(40, 120))
+    deadline = time.time() + 30
+    while len(read_logins(cache_home)) == count:
+        if time.time() > deadline or child.expect([pexpect.TIMEOUT, pexpect.EOF], timeout=0.01) == 1:
+            child.close(force=True)
+            raise RuntimeError('login did not finish: %s' % child.before[-200:])
+    while child.isalive():
+        child.sendline('exit')
+        child.expect([pexpect.TIMEOUT, pexpect.EOF], timeout=0.2)
+    child.close()
+    return read_logins(cache_home)[-1]
+
+
+def bench_login(options):
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, 'sshgo.py')
+    ssh_command = '%s %s' % (sys.executable, os.path.join(here, 'fake_ssh.py'))
+    metrics = {}
+    print('fake ssh delay %.0f ms per prompt, %d runs each' % (options.delay * 1000, options.repeat))
+    print('%-22s %10s %10s %10s   %s' % ('scenario', 'total', 'injected', 'overhead', 'median per step'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_home = os.path.join(tmp_dir, 'cache')
+        env = dict(os.environ, HOME=tmp_dir, XDG_CACHE_HOME=cache_home, TERM='xterm')
+        for name, hosts, title, prompts in login_scenarios(options.delay):
+            config_file = os.path.join(tmp_dir, 'ssh_hosts.json')
+            with open(config_file, 'w') as f:
+                json.dump(hosts, f)
+            args = [sys.executable, script, '-c', config_file, '--no-multiplex', '--no-cache', '--recent', '0',
+                    '--ssh-command', ssh_command, title]
+            records = [run_login(args, env, cache_home) for i in range(options.repeat)]
+            totals = [record['total'] for record in records]
+            injected = prompts * options.delay
+            steps = {}
+            for record in records:
+                for hop, key, seconds, skipped in record['steps']:
+                    steps.setdefault('%s:%s' % (hop, key), []).append(seconds)
+            print('%-22s %7.1f ms %7.1f ms %7.1f ms   %s' % (
+                name, statistics.median(totals) * 1000, injected * 1000,
+                (statistics.median(totals) - injected) * 1000,
+                ', '.join('%s %.1f' % (step, statistics.median(seconds) * 1000) for step, seconds in steps.items())))
+            metrics['%s overhead' % name] = (statistics.median(totals) - injected) * 1000
+    return metrics
+
+
+# 校准操作: ui 的操作都是纯python的计算，用排序和建dict；login 的耗时主要是启动python进程(sshgo 和 fake_ssh)
+def calibrate_cpu():
+    keys = ['host-%05d.example.com' % (i * 7919 % 20000) for i in range(20000)]
+
+    def op():
+        index = dict((key, i) for i, key in enumerate(sorted(keys)))
+        return sum(index[key] for key in keys if '9' in key)
+
+    return statistics.median(time_op(op, 21)) * 1000
+
+
+def calibrate_spawn():
+    import subprocess
+    return statistics.median(time_op(lambda: subprocess.call([sys.executable, '-c', 'pass']), 11)) * 1000
+
+
+CALIBRATIONS = {
+    'ui': calibrate_cpu,
+    'login': calibrate_spawn,
+}
+
+
+# 内存(MB)和机器快慢无关，直接保存；耗时(ms)保存为校准操作耗时的倍数
+def is_timing(name):
+    return not name.endswith(' MB')
+
+
+# 基线文件: {"benchmark名": {"calibration ms": 保存时校准操作的耗时, "metrics": {"指标": 数值}}}，都是越小越好
+def compare_baseline(path, benchmark, metrics, calibration, tolerance):
+    with open(path, 'r') as f:
+        baseline = json.load(f).get(benchmark, {})
+    expected = {}
+    for name, value in baseline.get('metrics', {}).items():
+        expected[name] = value * calibration if is_timing(name) else value
+    regressions = 0
+    print()
+    print('calibration: %.3f ms now, %.3f ms when %s was saved' % (calibration, baseline.get('calibration ms', 0),
+                                                                  os.path.basename(path)))
+    print('%-36s %12s %12s %8s' % ('metric (baseline scaled to now)', 'expected', 'now', 'ratio'))
+    for name, value in metrics.items():
+        if name not in expected:
+            continue
+        # 小于0.05ms的操作受计时误差影响太大，只在差距超过0.05ms时才算变慢
+        ratio = value / expected[name] if expected[name] else float('inf')
+        slower = ratio > 1 + tolerance and value - expected[name] > 0.05
+        regressions += slower
+        print('%-36s %12.3f %12.3f %7.2fx%s' % (name[:36], expected[name], value, ratio, '  REGRESSION' if slower else ''))
+    return regressions
+
+
+def save_baseline(path, benchmark, metrics, calibration):
+    baseline = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            baseline = json.load(f)
+    baseline[benchmark] = {
+        'calibration ms': round(calibration, 3),
+        'metrics': dict((name, float('%.4g' % (value / calibration if is_timing(name) else value)))
+                        for name, value in metrics.items()),
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'startup': bench_startup,
+    'record': bench_record,
+    'ui': bench_ui,
+    'login': bench_login,
+}
+
+
+def main():
+    parser = OptionParser(usage='%%prog [options] %s' % '|'.join(sorted(BENCHMARKS)))
+    parser.add_option('--hosts', type='int', default=15000, help='number of hosts in the synthetic inventory')
+    parser.add_option('--depth', type='int', default=2, help='group nesting depth')
+    parser.add_option('--fanout', type='int', default=10, help='sub groups per group')
+    parser.add_option('--repeat', type='int', default=20, help='repeat count for timed loops')
+    parser.add_option('--megabytes', type='int', default=64, help='session output size for the record benchmark')
+    parser.add_option('--lines', type='int', default=40, help='fake screen height for the ui benchmark')
+    parser.add_option('--cols', type='int', default=120, help='fake screen width for the ui benchmark')
+    parser.add_option('--delay', type='float', default=0.02,
+                      help='seconds fake_ssh.py waits before each prompt in the login benchmark')
+    parser.add_option('--baseline', metavar='FILE',
+                      help='compare ui/login results with FILE, exit 1 if an operation got slower than --tolerance')
+    parser.add_option('--save-baseline', metavar='FILE', help='write ui/login results to FILE as the new baseline')
+    parser.add_option('--tolerance', type='float', default=0.5,
+                      help='allowed slowdown against the baseline, 0.5 means 50%% slower, default %default')
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error('choose one benchmark: %s' % ', '.join(sorted(BENCHMARKS)))
+    metrics = BENCHMARKS[args[0]](options)
+    if metrics is None or (options.save_baseline is None and options.baseline is None):
+        return
+    calibration = CALIBRATIONS[args[0]]()
+    if options.save_baseline is not None:
+        save_baseline(options.save_baseline, args[0], metrics, calibration)
+    if options.baseline is not None and compare_baseline(options.baseline, args[0], metrics, calibration,
+                                                         options.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
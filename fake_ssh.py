@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 模拟ssh的交互过程，给 bench.py 测登录流程用，不需要真的ssh服务器:
+#   fake_ssh.py [--delay 秒] [--host-key] [--password 密码] [--motd 行数] [ssh的其他参数] user@host
+# 每个提示(确认主机公钥、输入密码、shell提示符)出现之前等待 --delay 秒。登录后是一个假的shell:
+# exit 退出，"ssh user@host" 在里面再登录一层(用同样的延迟和密码，模拟跳板机)，其他命令交给 bash -c 执行
+
+import sys
+import time
+import subprocess
+
+SSH_OPTIONS_WITH_ARG = frozenset('BbcDEeFIiJLlmOopQRSWw')
+
+
+def parse_args(args):
+    options = {'delay': 0.0, 'host_key': False, 'password': 'pw', 'motd': 0}
+    target = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--delay':
+            options['delay'] = float(args[i + 1])
+            i += 2
+        elif arg == '--host-key':
+            options['host_key'] = True
+            i += 1
+        elif arg == '--password':
+            options['password'] = args[i + 1]
+            i += 2
+        elif arg == '--motd':
+            options['motd'] = int(args[i + 1])
+            i += 2
+        elif arg.startswith('-') and len(arg) == 2 and arg[1] in SSH_OPTIONS_WITH_ARG:
+            i += 2
+        elif arg.startswith('-'):
+            i += 1
+        else:
+            target = arg
+            i += 1
+    return options, target or 'localhost'
+
+
+def prompt(text, delay):
+    if delay:
+        time.sleep(delay)
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    return sys.stdin.readline()
+
+
+def login(options, target, host_key):
+    host = target.split('@')[-1]
+    if host_key:
+        answer = prompt("The authenticity of host '%s (10.0.0.1)' can't be established.\r\n"
+                        "ED25519 key fingerprint is SHA256:sshgo+bench.\r\n"
+                        "Are you sure you want to continue connecting (yes/no/[fingerprint])? " % host, options['delay'])
+        if answer.strip() != 'yes':
+            sys.stdout.write('Host key verification failed.\r\n')
+            return False
+    if prompt("%s's password: " % target, options['delay']).strip() != options['password']:
+        sys.stdout.write('Permission denied, please try again.\r\n')
+        return False
+    lines = ['Last login: Wed May  1 12:00:00 2024 from 10.0.0.2']
+    lines.extend('motd line %d: the quick brown fox jumps over the lazy dog' % i for i in range(options['motd']))
+    sys.stdout.write('\r\n'.join(lines) + '\r\n')
+    return True
+
+
+def shell(options, target):
+    user, _, host = target.rpartition('@')
+    sign = '#' if user in ('', 'root') else '$'
+    while True:
+        line = prompt('[%s@%s ~]%s ' % (user or 'root', host, sign), options['delay'])
+        command = line.strip()
+        if not line or command == 'exit':
+            sys.stdout.write('logout\r\nConnection to %s closed.\r\n' % host)
+            sys.stdout.flush()
+            return
+        if command.startswith('ssh '):
+            nested_target = parse_args(command.split()[1:])[1]
+            if login(options, nested_target, False):
+                shell(options, nested_target)
+        elif command:
+            sys.stdout.flush()
+            subprocess.call(['bash', '-c', command])
+
+
+def main():
+    options, target = parse_args(sys.argv[1:])
+    if not login(options, target, options['host_key']):
+        sys.exit(255)
+    shell(options, target)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,1114 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+START_TIME = time.perf_counter()  # 用于 --profile-startup 统计各阶段耗时
+
 import os
 import sys
 import re
 import curses
-import traceback
 import locale
 import math
-import pexpect
+import bisect
 import struct
 import fcntl
 import termios
 import signal
+import shutil
 import json
-import argparse
-from collections import OrderedDict
+import pickle
+import gc
+import hashlib
+import hmac
+import base64
+import threading
+import codecs
+import collections
 from optparse import OptionParser
 
+# pexpect 和 traceback 只在真正登录主机或出错时才导入，减少启动时间
+pexpect = None
+
 sshHosts = sys.path[0] + "/ssh_hosts.json"  # ssh登录信息保存在同目录的.ssh_hosts.json文件中
+INVENTORY_CACHE_VERSION = 4
+
+
+def import_pexpect():
+    global pexpect
+    if pexpect is None:
+        import pexpect as module
+        pexpect = module
+    return pexpect
+
+
+def cache_dir():
+    path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'sshgo')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def control_dir():
+    path = os.path.join(cache_dir(), 'cm')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+# ControlMaster 的socket按起始主机的ssh参数区分，不同跳转链共用同一个跳板机时也能复用
+def control_path_for(ssh_param, directory=None):
+    return os.path.join(directory or control_dir(), hashlib.sha1(ssh_param.encode('utf-8')).hexdigest()[:20])
+
+
+# socket文件还在不代表master还活着: ssh崩溃或重启后会留下连不上的socket，要真正connect一次
+def control_master_alive(control_path):
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(control_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        client.close()
+
+
+def is_auth_step(expect):
+    for key in expect:
+        return key == 'passwd' or re.search('[Pp]assword|passphrase|密码', key) is not None
+    return False
+
+
+def cache_file_for(config_file, suffix):
+    key = hashlib.sha1(os.path.realpath(config_file).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir(), '%s.%s' % (key, suffix))
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ConfigError(Exception):
+    pass
+
+
+# 登录耗时记录: 每次登录追加一行JSON到 cache_dir()/logins.jsonl，由 sshgo stats 统计
+def login_history_file():
+    return os.path.join(cache_dir(), 'logins.jsonl')
+
+
+def append_login_record(record):
+    try:
+        with open(login_history_file(), 'a') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    except OSError:
+        pass
+
+
+def read_login_records():
+    try:
+        f = open(login_history_file(), 'r')
+    except OSError:
+        return
+    with f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:  # 另一个进程写到一半的行
+                continue
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+# sshgo stats [title ...]: 按主机和按跳转链上的每一跳统计登录耗时的p50/p95
+def print_login_stats(titles=()):
+    hosts = {}  # title -> [次数, 失败次数, 成功登录的耗时, 最后一次登录时间]
+    hops = {}  # 跳板机或主机 -> 每次登录在这一跳上的耗时
+    for record in read_login_records():
+        if len(titles) and record.get('host') not in titles:
+            continue
+        host = hosts.setdefault(record.get('host'), [0, 0, [], 0])
+        host[0] += 1
+        host[3] = max(host[3], record.get('time', 0))
+        if not record.get('ok'):
+            host[1] += 1
+            continue
+        host[2].append(record.get('total', 0))
+        per_hop = {}
+        for hop, key, seconds, skipped in record.get('steps', ()):
+            per_hop[hop] = per_hop.get(hop, 0) + seconds
+        for hop, seconds in per_hop.items():
+            hops.setdefault(hop, []).append(seconds)
+    if not len(hosts):
+        print('no login recorded yet (%s)' % login_history_file())
+        return
+    width = max(len(str(title)) for title in list(hosts) + list(hops) + ['host'])
+    print('%-*s %7s %5s %9s %9s  %s' % (width, 'host', 'logins', 'fail', 'p50', 'p95', 'last'))
+    for title in sorted(hosts, key=str):
+        count, failed, totals, last = hosts[title]
+        p50, p95 = ('%.0fms' % (percentile(totals, 50) * 1000), '%.0fms' % (percentile(totals, 95) * 1000)) \
+            if len(totals) else ('-', '-')
+        print('%-*s %7d %5d %9s %9s  %s' % (width, title, count, failed, p50, p95,
+                                             time.strftime('%Y-%m-%d %H:%M', time.localtime(last))))
+    print('\n%-*s %7s %5s %9s %9s' % (width, 'hop', 'samples', '', 'p50', 'p95'))
+    for hop in sorted(hops, key=lambda hop: -percentile(hops[hop], 95)):  # 最慢的跳板机排在前面
+        print('%-*s %7d %5s %8.0fms %8.0fms' % (width, hop, len(hops[hop]), '', percentile(hops[hop], 50) * 1000,
+                                                percentile(hops[hop], 95) * 1000))
+
+
+# 被include的配置文件: .json 是节点数组，.jsonl 每行一个节点，第一行可以是 {"header": {"title", "count", "expanded"}}
+def read_inventory_file(path):
+    with open(path, 'r') as f:
+        if not path.endswith('.jsonl'):
+            for record in json.load(f):
+                yield record
+            return
+        for line in f:  # 逐行解析，不需要一次把整个文件读进内存
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                if 'header' not in record:
+                    yield record
+
+
+def read_inventory_header(path):
+    if not path.endswith('.jsonl'):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.readline()).get('header', {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+# 配置中的每个节点。用 __slots__ 代替json解析出来的dict，减少大配置下的内存和查找开销
+class Node:
+    __slots__ = ('title', 'ssh', 'pre_host', 'expect', 'expanded', 'parent', 'level', 'line_number')
+    NO_EXPECT = ()
+    is_group = False
+    include = None
+
+    def __init__(self, title, ssh, pre_host, expect, expanded, parent, level, line_number):
+        self.title = title
+        self.ssh = ssh
+        self.pre_host = pre_host
+        self.expect = expect
+        self.expanded = expanded
+        self.parent = parent
+        self.level = level
+        self.line_number = line_number
+
+
+class HostNode(Node):
+    __slots__ = ()
+    sub_node = ()
+
+
+class GroupNode(Node):
+    __slots__ = ('sub_node',)
+    is_group = True
+
+    def child_count(self):
+        return len(self.sub_node)
+
+
+# 通过include引用其他文件的组，第一次展开或搜索时才解析子节点。include为None表示已经加载，source一直保存文件路径
+class LazyGroupNode(GroupNode):
+    __slots__ = ('include', 'count', 'source')
+
+    def child_count(self):
+        if self.include is None:
+            return len(self.sub_node)
+        return '?' if self.count is None else self.count
+
+
+# 登录和批量执行时用到的提示符和标记。发送时标记中间加了''，远端回显的命令行不会被当成标记
+PROMPT_PATTERN = re.compile(r'[$#] ')
+PASSWORD_PATTERN = '[Pp]assword: |密码：'
+HOST_KEY_PATTERN = r'Are you sure you want to continue connecting \(yes/no'
+BATCH_BEGIN_PATTERN = re.compile(r'__SSHGO_BEGIN\r?\n')
+BATCH_RC_PATTERN = re.compile(r'__SSHGO_RC=(\d+)')
+HANDSHAKE_WINDOW = 4096  # 登录阶段只在输出的最后4K里找提示符，MOTD再长也不影响匹配速度
+PS1_STYLES = {
+    'ps1': "export PS1='\\[\\e[30;46m\\]%s:\\w\\[\\e[36;42m\\]▶\\[\\e[30;42m\\]\\t \\$\\[\\e[0m\\]\\[\\e[32m\\]▶\\[\\e[0m\\]'",
+    'ps1-bench': "export PS1='\\[\\e[30;42m\\]%s:\\w\\[\\e[32;43m\\]▶\\[\\e[30;43m\\]\\t \\$\\[\\e[0m\\]\\[\\e[33m\\]▶\\[\\e[0m\\]'",
+    'ps1-prod': "export PS1='\\[\\e[30;43m\\]%s:\\w\\[\\e[33;45m\\]▶\\[\\e[37;45m\\]\\t \\$\\[\\e[0m\\]\\[\\e[35m\\]▶\\[\\e[0m\\]'",
+}
+
+
+class LoginTimeout(Exception):
+    pass
+
+
+# 登录流程的状态机: 把 expect 列表编译成步骤，每一步的几个提示符预先合并成一个正则，一次扫描找出最先出现的。
+# feed() 收到远端输出后返回要发送的内容和命令的输出行，本身不读写连接，
+# 交互登录时由 do_ssh 驱动，批量执行时一个线程用 selectors 同时驱动很多个连接。
+# command 为 None 时是交互登录，走完所有步骤就结束；否则跳过 ps1/setTitle，等到shell提示符后执行 command
+class Handshake:
+    def __init__(self, expect_list, command=None, title='', step_timeout=30, total_timeout=120, owners=None):
+        self.steps = []  # (所属主机, 键, 合并后的正则, 应答, 出现shell提示符时是否跳过这一步)
+        for expect in expect_list:
+            for key in expect:
+                hop = '' if owners is None else owners.get(id(expect), '')
+                if key == 'passwd':
+                    self.steps.append((hop, key, self._compile(HOST_KEY_PATTERN, PASSWORD_PATTERN,
+                                                               PROMPT_PATTERN.pattern), expect[key], True))
+                elif key in PS1_STYLES or key == 'setTitle':
+                    if command is not None:
+                        break  # 只影响终端显示的步骤批量执行时跳过
+                    if key == 'setTitle':
+                        reply = "PROMPT_COMMAND='echo -ne \"\\033]0;%s\\007\"'" % (expect[key] or title)  # 设置本地终端的标题
+                    else:
+                        reply = PS1_STYLES[key] % expect[key]
+                    # 设置本地终端标题 和 设置PS1 前需要确保已经进入了bash
+                    self.steps.append((hop, key, self._compile(HOST_KEY_PATTERN, '[$#]'), reply, False))
+                else:
+                    self.steps.append((hop, key, self._compile(HOST_KEY_PATTERN, re.escape(key)), expect[key], False))
+                break  # 每个expect应只有一个键值对,多余的忽略掉.
+        self.command = None if command is None else command.strip().rstrip(';')
+        self.title = title
+        self.step_timeout = step_timeout
+        self.total_timeout = total_timeout
+        self.buffer = ''
+        self.step = 0
+        self.state = 'login'  # login -> prompt -> begin -> running -> done
+        self.exit_code = None
+        self.started = self.step_started = time.time()
+        self.timings = []  # (所属主机, 键, 耗时秒数, 是否跳过)
+
+    @staticmethod
+    def _compile(*patterns):
+        return re.compile('|'.join('(%s)' % pattern for pattern in patterns))
+
+    def current_step(self):
+        if self.state == 'login' and self.step < len(self.steps):
+            return self.steps[self.step][:2]
+        return self.title, 'shell prompt' if self.state == 'prompt' else self.state
+
+    def step_label(self):
+        hop, key = self.current_step()
+        return '%s: %s' % (hop, key) if len(hop) else key
+
+    # 距离当前步骤或整个登录超时还剩的秒数
+    def time_left(self, now=None):
+        now = time.time() if now is None else now
+        if self.state == 'running':  # 命令执行时间不限制
+            return self.started + self.total_timeout - now if self.total_timeout else None
+        deadlines = [self.step_started + self.step_timeout] if self.step_timeout else []
+        if self.total_timeout:
+            deadlines.append(self.started + self.total_timeout)
+        return min(deadlines) - now if len(deadlines) else None
+
+    def check_deadline(self, now=None):
+        left = self.time_left(now)
+        if left is not None and left <= 0:
+            raise LoginTimeout('timeout waiting for "%s" after %.1fs' % (self.step_label(), time.time() - self.started))
+
+    def _next_step(self, skipped=False):
+        now = time.time()
+        self.timings.append(self.current_step() + (now - self.step_started, skipped))
+        self.step_started = now
+        self.step += 1
+
+    def feed(self, data):
+        self.buffer += data
+        replies = []
+        lines = []
+        while self.state != 'done':
+            if self.state == 'login' and self.step == len(self.steps):
+                self.state = 'prompt' if self.command is not None else 'done'
+                continue
+            if self.state in ('login', 'prompt') and len(self.buffer) > HANDSHAKE_WINDOW:
+                self.buffer = self.buffer[-HANDSHAKE_WINDOW:]
+            if self.state == 'login':
+                hop, key, pattern, reply, skippable = self.steps[self.step]
+                match = pattern.search(self.buffer)
+                if match is None:
+                    break
+                if match.lastindex == 3:  # 提供了密码但是实际不需要输入密码就进去了，提示符留给下一步匹配
+                    self._next_step(True)
+                    continue
+                self.buffer = self.buffer[match.end():]
+                if match.lastindex == 1:  # SSH does not have the public key. Just accept it.
+                    replies.append('yes')
+                else:
+                    replies.append(reply)
+                    self._next_step()
+            elif self.state == 'prompt':
+                match = PROMPT_PATTERN.search(self.buffer)
+                if match is None:
+                    break
+                self.buffer = self.buffer[match.end():]
+                replies.append("echo __SSHGO''_BEGIN; %s; echo __SSHGO''_RC=$?" % self.command)
+                self.timings.append((self.title, 'shell prompt', time.time() - self.step_started, False))
+                self.state = 'begin'
+            elif self.state == 'begin':
+                match = BATCH_BEGIN_PATTERN.search(self.buffer)
+                if match is None:
+                    break
+                self.buffer = self.buffer[match.end():]
+                self.state = 'running'
+            else:  # running: 输出按整行返回，直到出现退出码标记
+                match = BATCH_RC_PATTERN.search(self.buffer)
+                end = match.start() if match is not None else self.buffer.rfind('\n') + 1
+                lines.extend(line.rstrip('\r') for line in self.buffer[:end].split('\n'))
+                if not len(lines[-1]):
+                    lines.pop()
+                self.buffer = self.buffer[end:]
+                if match is None:
+                    break
+                self.exit_code = int(match.group(1))
+                self.buffer = ''
+                self.state = 'done'
+                replies.append('exit')
+        return replies, lines
+
+
+class BatchJob:
+    __slots__ = ('node', 'child', 'handshake', 'start', 'connected', 'finished', 'status')
+
+    def __init__(self, node, child, handshake, start):
+        self.node = node
+        self.child = child
+        self.handshake = handshake
+        self.start = start
+        self.connected = None  # 发送命令的时间
+        self.finished = None
+        self.status = None
+
+
+# 登录后按 Ctrl-] 回到主机列表时保留下来的会话。在后台时输出读进缓冲区(最多 buffer_size 字节，
+# 超出时从最早的整行开始丢弃): 停在主机列表时由主循环读，另一个会话在前台时由 _interact 读，
+# 远端不会因为pty写满而阻塞；切换回来时先重放缓冲区里的内容
+class Session:
+    __slots__ = ('node', 'child', 'buffer', 'recorder')
+    buffer_size = 256 * 1024
+
+    def __init__(self, node, child, recorder=None):
+        self.node = node
+        self.child = child
+        self.buffer = bytearray()
+        self.recorder = recorder
+
+    # 前台的输出也记下来，切换回来时能看到之前的屏幕内容
+    def record(self, data):
+        if self.recorder is not None:
+            self.recorder.write(data)
+        self.buffer += data
+        overflow = len(self.buffer) - self.buffer_size
+        if overflow > 0:
+            cut = self.buffer.find(b'\n', overflow)
+            del self.buffer[:overflow if cut < 0 else cut + 1]
+        return data
+
+    def drain(self):
+        try:
+            data = os.read(self.child.child_fd, 65536)
+        except OSError:  # 远端已经退出(EIO)
+            return False
+        self.record(data)
+        return len(data) > 0
+
+
+# 会话录像(--record)，asciicast v2 格式，可以用 asciinema play 回放。输出路径上只把原始字节攒在内存里，
+# 攒够 flush_bytes 或者距离第一块超过 flush_interval 秒时合并成一个事件交给写录像的线程，
+# 解码、转成json和写文件都在那个线程里做，输出很多的会话(比如tail日志)不会因为录像变慢。
+# 文件超过 max_size 字节时换一个新文件(每个文件都有自己的头部，可以单独回放)，只保留最近的 keep 个
+class TranscriptRecorder:
+    flush_bytes = 65536
+    flush_interval = 0.05
+
+    def __init__(self, directory, title, max_size=64 << 20, keep=5):
+        import queue
+        os.makedirs(directory, mode=0o700, exist_ok=True)  # 录像里可能有敏感信息
+        base = self.base = os.path.join(directory, '%s-%s' % (re.sub(r'[^\w.-]+', '_', title),
+                                                              time.strftime('%Y%m%d-%H%M%S')))
+        n = 1
+        while os.path.exists(self.base + '.cast'):  # 同一秒内又登录了同一台主机
+            n += 1
+            self.base = '%s-%d' % (base, n)
+        self.parts = []
+        self.title = title
+        self.max_size = max_size
+        self.keep = max(keep, 1)
+        self.pending = bytearray()
+        self.pending_time = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')  # 多字节字符可能被切在两块之间
+        self.file = None
+        self.size = 0
+        self.start = 0
+        self._open()
+        self.events = queue.SimpleQueue()  # (时间, 原始字节)，None 表示结束
+        self.writer = threading.Thread(target=self._write_events, daemon=True)
+        self.writer.start()
+
+    def _open(self):
+        path = self.base + ('.%d.cast' % len(self.parts) if len(self.parts) else '.cast')
+        self.parts.append(path)
+        if len(self.parts) > self.keep:
+            try:
+                os.unlink(self.parts[-self.keep - 1])
+            except OSError:
+                pass
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.file = os.fdopen(fd, 'wb', buffering=self.flush_bytes)
+        self.start = time.time()
+        columns, lines = shutil.get_terminal_size()
+        header = {'version': 2, 'width': columns, 'height': lines, 'timestamp': int(self.start), 'title': self.title,
+                  'env': {'TERM': os.environ.get('TERM', '')}}
+        self.size = self.file.write((json.dumps(header, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    # 登录阶段pexpect给的是str，interact 和后台读到的是bytes
+    def write(self, data):
+        now = time.time()
+        if self.pending_time is None:
+            self.pending_time = now
+        self.pending += data.encode('utf-8') if isinstance(data, str) else data
+        if len(self.pending) >= self.flush_bytes or now - self.pending_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not len(self.pending):
+            return
+        self.events.put((self.pending_time, self.pending))
+        self.pending = bytearray()
+        self.pending_time = None
+
+    def close(self):
+        self.flush()
+        self.events.put(None)
+        self.writer.join()
+
+    def _write_events(self):
+        failed = False
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            if failed:
+                continue
+            # json.dumps 单独处理字符串时直接走C实现的ASCII转义，比dumps整个列表或者ensure_ascii=False快
+            line = '[%.6f, "o", %s]\n' % (event[0] - self.start, json.dumps(self.decoder.decode(event[1])))
+            try:
+                self.size += self.file.write(line.encode('ascii'))
+                if self.size >= self.max_size:
+                    self.file.close()
+                    self._open()
+            except OSError:  # 比如磁盘满了，放弃剩下的录像，不影响会话
+                failed = True
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+
+# 最近/常用的主机: 每次登录给主机的分数加1，分数按半衰期指数衰减(frecency)，只保留分数最高的 max_entries 个
+class UsageCache:
+    half_life = 3 * 86400
+    max_entries = 200
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # title -> (上次使用时的分数, 上次使用时间)
+        try:
+            with open(path, 'r') as f:
+                self.entries = dict((title, tuple(entry)) for title, entry in json.load(f).items())
+        except (OSError, ValueError, AttributeError, TypeError):
+            pass
+
+    def score(self, title, now=None):
+        entry = self.entries.get(title)
+        if entry is None:
+            return 0
+        now = time.time() if now is None else now
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life)
+
+    def scores(self):
+        now = time.time()
+        return dict((title, self.score(title, now)) for title in self.entries)
+
+    def ranked(self):
+        scores = self.scores()
+        return sorted(scores, key=lambda title: -scores[title])
+
+    def touch(self, title):
+        now = time.time()
+        self.entries[title] = (self.score(title, now) + 1, now)
+        if len(self.entries) > self.max_entries:
+            for title in self.ranked()[self.max_entries:]:
+                del self.entries[title]
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            pass
+
+
+SSH_OPTIONS_WITH_ARG = frozenset('BbcDEeFIiJLlmOopQRSWw')
+
+
+# 从ssh参数中解析出要连接的主机和端口，如 "k@127.0.0.1 -p 22" -> ('127.0.0.1', 22)
+def ssh_target(ssh_param):
+    host = None
+    port = '22'
+    args = ssh_param.split()
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('-') and len(arg) > 1:
+            option, value = arg[1], arg[2:]
+            if option in SSH_OPTIONS_WITH_ARG:
+                if not len(value) and i + 1 < len(args):
+                    i += 1
+                    value = args[i]
+                if option == 'p':
+                    port = value
+                elif option == 'o' and value.lower().startswith('port='):
+                    port = value[5:]
+        elif host is None:
+            host = arg
+        i += 1
+    if host is None:
+        return None
+    if host.startswith('ssh://'):
+        host, _, uri_port = host[6:].partition(':')
+        port = uri_port or port
+    host = host.rpartition('@')[2]
+    try:
+        return host, int(port)
+    except ValueError:
+        return None
+
+
+# 后台探测主机是否可达: 在单独的线程里跑asyncio，并发地TCP连接各主机的ssh端口(可选读取SSH banner)。
+# 结果带时间戳保存在 cache_dir()/probe.json，ttl 内的结果直接使用，不重复探测
+class Prober:
+    concurrency = 64
+    timeout = 3
+
+    def __init__(self, ttl=300, banner=False):
+        self.ttl = ttl
+        self.banner = banner
+        self.results = {}  # 'host:port' -> (探测时间, rtt秒数或None, banner或出错原因)
+        self.queued = set()
+        self.aliases = {}  # (host, port) -> ssh -G 解析出的 (hostname, port)，只有DNS解析不了的主机名
+        self.version = 0  # 每得到一个结果加1，界面据此重绘
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 每次probe()一个线程，写缓存文件时要排队，后取的快照后写
+        self.cache_file = os.path.join(cache_dir(), 'probe.json')
+        try:
+            with open(self.cache_file, 'r') as f:
+                self.results = dict((key, tuple(value)) for key, value in json.load(f).items())
+        except (OSError, ValueError, AttributeError, TypeError):
+            pass
+
+    @property
+    def pending(self):
+        return len(self.queued)
+
+    def probe(self, targets, force=False):
+        now = time.time()
+        with self.lock:
+            targets = set(target for target in targets if '%s:%d' % target not in self.queued and (
+                force or now - self.results.get('%s:%d' % target, (0,))[0] > self.ttl))
+            self.queued.update('%s:%d' % target for target in targets)
+        if len(targets):
+            threading.Thread(target=self._run, args=(targets,), daemon=True).start()
+
+    def _run(self, targets):
+        import asyncio
+        try:
+            asyncio.run(self._probe_all(targets))
+        finally:
+            with self.lock:  # 线程意外退出时也要让这些主机可以重新探测
+                self.queued.difference_update('%s:%d' % target for target in targets)
+        with self.save_lock:
+            with self.lock:
+                results = dict(self.results)
+            try:
+                with open(self.cache_file + '.tmp', 'w') as f:
+                    json.dump(results, f)
+                os.replace(self.cache_file + '.tmp', self.cache_file)
+            except OSError:
+                pass
+
+    async def _probe_all(self, targets):
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self._probe_one(semaphore, target) for target in targets))
+
+    async def _probe_one(self, semaphore, target):
+        import asyncio
+        import socket
+        key = '%s:%d' % target
+        try:
+            async with semaphore:
+                try:
+                    try:
+                        reader, writer, rtt = await self._connect(self.aliases.get(target, target))
+                    except socket.gaierror:  # DNS解析不了的可能是 ~/.ssh/config 里的别名
+                        alias = await self._resolve(target)
+                        if alias == target:
+                            raise
+                        reader, writer, rtt = await self._connect(alias)
+                    info = ''
+                    if self.banner:
+                        try:
+                            info = (await asyncio.wait_for(reader.readline(), self.timeout)).decode('utf-8', 'replace').strip()
+                        except (asyncio.TimeoutError, OSError):
+                            info = 'no banner'
+                    writer.close()
+                except asyncio.TimeoutError:
+                    rtt, info = None, 'timeout'
+                except socket.gaierror:  # 解析不了的主机名不算down，界面上不显示
+                    rtt, info = None, 'unresolved'
+                except OSError as e:
+                    rtt, info = None, e.strerror or str(e)
+                except Exception as e:  # 比如某一段超过63个字符的主机名，idna编码时出错
+                    rtt, info = None, str(e) or type(e).__name__
+            with self.lock:
+                self.results[key] = (time.time(), rtt, info)
+        finally:
+            with self.lock:
+                self.queued.discard(key)
+                self.version += 1
+
+    async def _connect(self, target):
+        import asyncio
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*target), self.timeout)
+        return reader, writer, time.perf_counter() - start
+
+    # ~/.ssh/config 里的别名: 用 ssh -G 取实际的 HostName 和 Port，结果在本进程里缓存。
+    # 每个ssh -G 都要起一个进程，只对DNS解析不了的主机名用；端口是默认的22时不传 -p，让配置里的 Port 生效
+    async def _resolve(self, target):
+        import asyncio
+        host, port = target
+        if target in self.aliases:
+            return self.aliases[target]
+        config = os.path.expanduser('~/.ssh/config')
+        if not os.path.exists(config):
+            return target
+        resolved = target
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'ssh', '-G', '-F', config, *(['-p', str(port)] if port != 22 else []), host,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL, stdin=asyncio.subprocess.DEVNULL)
+            output = (await asyncio.wait_for(process.communicate(), self.timeout))[0].decode('utf-8', 'replace')
+            if process.returncode == 0:
+                options = dict(line.partition(' ')[::2] for line in output.splitlines())
+                resolved = options.get('hostname', host), int(options.get('port', port))
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        self.aliases[target] = resolved
+        return resolved
+
+    def health(self, target):
+        key = '%s:%d' % target
+        result = self.results.get(key)
+        if result is None:
+            return ('...', True) if key in self.queued else None
+        if result[1] is None:
+            if result[2] == 'unresolved':
+                return None
+            return 'down', False
+        return '%dms' % max(round(result[1] * 1000), 1), True
+
+
+# 命令行补全的索引: 每行 "title<Tab>组路径"，按title排序，shell里可以直接用look二分查找，不需要启动python解析配置。
+# 同名的 .deps 文件每行一个索引依赖的文件(配置文件或目录、include的文件)，任何一个比索引新时需要重建；
+# .sock 是可选的补全守护进程(--complete-daemon)监听的socket
+def completion_index_for(config_file):
+    return cache_file_for(config_file, 'complete')
+
+
+def completion_index_fresh(index_file):
+    try:
+        mtime = os.stat(index_file).st_mtime_ns
+        with open(index_file + '.deps', 'r') as f:
+            return all(os.stat(path).st_mtime_ns <= mtime for path in f.read().splitlines())
+    except OSError:
+        return False
+
+
+def ensure_completion_index(config_file, use_cache=True):
+    index_file = completion_index_for(config_file)
+    if not completion_index_fresh(index_file):
+        SSHGO(config_file, use_cache=use_cache, recent_size=0).write_completion_index(index_file)
+    return index_file
+
+
+def read_completion_index(index_file):
+    with open(index_file, 'r') as f:
+        return f.read().splitlines()
+
+
+def complete_prefix(lines, prefix):
+    start = end = bisect.bisect_left(lines, prefix)
+    while end < len(lines) and lines[end].startswith(prefix):
+        end += 1
+    return lines[start:end]
+
+
+# 本地Unix socket上的一问一答: 发送一行请求，读到对方关闭连接为止。补全守护进程和密码agent共用
+def unix_socket_request(socket_path, request, timeout=1):
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall((request + '\n').encode('utf-8'))
+        chunks = []
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        client.close()
+    return b''.join(chunks).decode('utf-8')
+
+
+def query_completion_daemon(socket_path, prefix):
+    return unix_socket_request(socket_path, prefix).splitlines()
+
+
+# 只有当前用户能连接的socket(权限0600)。在fork之前绑定，父进程返回时就已经可以连接，不用等子进程
+def bind_unix_socket(path):
+    import socket
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(path)  # 上次异常退出留下的socket
+    except OSError:
+        pass
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    return server
+
+
+# 逐个处理连接: 读一行请求，handle(conn, request) 返回应答。deadline() 返回退出的时间点，每次等待连接前重新计算，
+# 退出(包括被kill)时删掉socket
+def serve_unix_socket(server, path, handle, deadline):
+    import socket
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    try:
+        while True:
+            left = deadline() - time.time()
+            if left <= 0:
+                break
+            server.settimeout(left)
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                conn.settimeout(1)
+                try:
+                    request = conn.makefile('r', encoding='utf-8').readline().rstrip('\n')
+                    conn.sendall(handle(conn, request).encode('utf-8'))
+                except (OSError, ValueError):
+                    pass
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+# 补全守护进程: 索引常驻内存，每次查询前检查依赖的文件有没有变化，空闲 idle_timeout 秒后自动退出
+class CompletionDaemon:
+    idle_timeout = 3600
+
+    def __init__(self, config_file, use_cache=True):
+        self.config_file = config_file
+        self.use_cache = use_cache
+        self.index_file = completion_index_for(config_file)
+        self.socket_path = self.index_file + '.sock'
+        self.lines = None
+        self.last_used = 0
+
+    def refresh(self):
+        if self.lines is None or not completion_index_fresh(self.index_file):
+            self.lines = read_completion_index(ensure_completion_index(self.config_file, self.use_cache))
+
+    def serve(self):
+        try:
+            query_completion_daemon(self.socket_path, '\0')
+            print('completion daemon already running on %s' % self.socket_path)
+            return
+        except OSError:
+            pass
+        self.refresh()
+        self.last_used = time.time()
+        serve_unix_socket(bind_unix_socket(self.socket_path), self.socket_path, self.handle,
+                          lambda: self.last_used + self.idle_timeout)
+
+    def handle(self, conn, prefix):
+        self.last_used = time.time()
+        self.refresh()
+        return ''.join(line + '\n' for line in complete_prefix(self.lines, prefix))
+
+
+# eval "$(sshgo.py --completion-script bash)" 加载。索引过期或者还没有时调用一次 --complete-index，
+# 之后每次补全只是几个stat加一次look(没有look时用awk)；有守护进程并且装了socat时直接问守护进程
+BASH_COMPLETION = r'''_sshgo_lookup() {
+    if [[ -S $1.sock ]] && type -P socat >/dev/null; then
+        printf '%%s\n' "$2" | socat -t1 - "UNIX-CONNECT:$1.sock" 2>/dev/null && return
+    fi
+    if type -P look >/dev/null; then
+        look -- "$2" "$1"
+    else
+        SSHGO_PREFIX=$2 awk 'index($0, ENVIRON["SSHGO_PREFIX"]) == 1' "$1"
+    fi
+}
+_sshgo() {
+    local cur=${COMP_WORDS[COMP_CWORD]} prev=${COMP_WORDS[COMP_CWORD-1]}
+    local program=${COMP_WORDS[0]/#\~/$HOME} config= index stale= dep title rest i
+    case $prev in
+        -c|--config) COMPREPLY=($(compgen -f -- "$cur")); return;;
+        %(value_options)s) return;;
+    esac
+    if [[ $cur == -* ]]; then
+        COMPREPLY=($(compgen -W '%(options)s' -- "$cur"))
+        return
+    fi
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case ${COMP_WORDS[i]} in -c|--config) config=${COMP_WORDS[i+1]};; esac
+    done
+    index=${_sshgo_index[x$config]}
+    if [[ -n $index && -f $index && -f $index.deps ]]; then
+        while IFS= read -r dep; do
+            [[ $dep -nt $index ]] && { stale=1; break; }
+        done < "$index.deps"
+    fi
+    if [[ -z $index || ! -f $index || -n $stale ]]; then
+        index=$("$program" ${config:+--config "$config"} --complete-index 2>/dev/null) || return
+        _sshgo_index[x$config]=$index
+    fi
+    COMPREPLY=()
+    while IFS=$'\t' read -r title rest; do
+        [[ -n $title ]] && printf -v 'COMPREPLY[${#COMPREPLY[@]}]' '%%q' "$title"
+    done < <(_sshgo_lookup "$index" "$cur")
+}
+declare -gA _sshgo_index
+complete -F _sshgo sshgo sshgo.py
+'''
+
+ZSH_COMPLETION = r'''#compdef sshgo sshgo.py
+_sshgo_lookup() {
+    if [[ -S $1.sock ]] && (( $+commands[socat] )); then
+        print -r -- "$2" | socat -t1 - "UNIX-CONNECT:$1.sock" 2>/dev/null && return
+    fi
+    if (( $+commands[look] )); then
+        look -- "$2" "$1"
+    else
+        SSHGO_PREFIX=$2 awk 'index($0, ENVIRON["SSHGO_PREFIX"]) == 1' "$1"
+    fi
+}
+_sshgo() {
+    local program=${~words[1]} config= index stale= dep i
+    local -a lines described
+    case ${words[CURRENT-1]} in
+        -c|--config) _files; return;;
+        %(value_options)s) return 1;;
+    esac
+    if [[ $PREFIX == -* ]]; then
+        compadd -- %(options)s
+        return
+    fi
+    for ((i = 2; i < CURRENT; i++)); do
+        [[ ${words[i]} == (-c|--config) ]] && config=${words[i+1]}
+    done
+    index=${_sshgo_index[x$config]}
+    if [[ -n $index && -f $index && -f $index.deps ]]; then
+        for dep in ${(f)"$(<$index.deps)"}; do
+            [[ $dep -nt $index ]] && { stale=1; break; }
+        done
+    fi
+    if [[ -z $index || ! -f $index || -n $stale ]]; then
+        index=$($program ${config:+--config "$config"} --complete-index 2>/dev/null) || return 1
+        _sshgo_index[x$config]=$index
+    fi
+    lines=(${(f)"$(_sshgo_lookup $index $PREFIX)"})
+    described=(${${lines//:/\\:}/$'\t'/:})
+    _describe -t hosts 'host or group' described
+}
+typeset -gA _sshgo_index
+compdef _sshgo sshgo sshgo.py
+'''
+
+
+# 密码库: expect 的值里用 ${secret:NAME} 引用，明文密码不用写在配置文件里。只用标准库:
+# 主密码经 scrypt 派生出加密和校验两个密钥，每个密码用随机nonce和 HMAC-SHA256 计数器模式生成的密钥流异或加密，
+# 再对 名字+nonce+密文 计算HMAC(先加密后校验)，密文被篡改或者换到别的名字下都会校验失败
+SECRET_PATTERN = re.compile(r'\$\{secret:([^}]+)\}')
+
+
+def secrets_file_default():
+    return os.path.join(os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'sshgo', 'secrets.json')
+
+
+def agent_socket_for(secrets_file):
+    return cache_file_for(secrets_file, 'agent.sock')
+
+
+def agent_request(socket_path, request):
+    status, _, value = unix_socket_request(socket_path, request).rstrip('\n').partition(' ')
+    if status != 'ok':
+        raise ConfigError(value or 'no reply from secret agent')
+    return value
+
+
+class SecretStore:
+    scrypt_n = 1 << 15
+    scrypt_r = 8
+    scrypt_p = 1
+    check_message = b'sshgo secrets'
+
+    def __init__(self, path):
+        self.path = path
+        self.kdf = None
+        self.check = None
+        self.secrets = {}  # name -> {'nonce', 'data', 'mac'}，都是base64
+        self.enc_key = self.mac_key = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.kdf, self.check, self.secrets = data['kdf'], data['check'], data['secrets']
+        except OSError as e:
+            raise ConfigError('cannot read secret store %s: %s, create it with "secret init"' % (self.path, e.strerror))
+        except (ValueError, KeyError, TypeError):
+            raise ConfigError('secret store %s is corrupted' % self.path)
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+        fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': 1, 'kdf': self.kdf, 'check': self.check, 'secrets': self.secrets}, f,
+                      indent=2, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+    def init(self, password):
+        self.kdf = {'name': 'scrypt', 'salt': base64.b64encode(os.urandom(16)).decode('ascii'),
+                    'n': self.scrypt_n, 'r': self.scrypt_r, 'p': self.scrypt_p}
+        self.secrets = {}
+        self.use_key(self.derive(password))
+        self.check = base64.b64encode(hmac.new(self.mac_key, self.check_message, 'sha256').digest()).decode('ascii')
+
+    def derive(self, password):
+        n, r, p = self.kdf['n'], self.kdf['r'], self.kdf['p']
+        return hashlib.scrypt(password.encode('utf-8'), salt=base64.b64decode(self.kdf['salt']), n=n, r=r, p=p,
+                              maxmem=2 * 128 * r * n * p, dklen=64)
+
+    def use_key(self, key):
+        self.enc_key, self.mac_key = key[:32], key[32:]
+
+    def unlock(self, password):
+        self.use_key(self.derive(password))
+        if not hmac.compare_digest(hmac.new(self.mac_key, self.check_message, 'sha256').digest(),
+                                   base64.b64decode(self.check)):
+            self.enc_key = self.mac_key = None
+            raise ConfigError('wrong master password for %s' % self.path)
+
+    # 终端上输入主密码，最多试 attempts 次
+    def prompt_unlock(self, attempts=3):
+        import getpass
+        for i in range(attempts):
+            try:
+                self.unlock(getpass.getpass('master password for %s: ' % self.path))
+                return self
+            except ConfigError as e:
+                if i == attempts - 1:
+                    raise
+                print(e, file=sys.stderr)
+
+    def _xor(self, nonce, data):
+        stream = b''.join(hmac.new(self.enc_key, nonce + struct.pack('>Q', counter), 'sha256').digest()
+                          for counter in range((len(data) + 31) // 32))[:len(data)]
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
+
+    def _mac(self, name, nonce, data):
+        return hmac.new(self.mac_key, name.encode('utf-8') + b'\0' + nonce + data, 'sha256').digest()
+
+    def set(self, name, value):
+        nonce = os.urandom(16)
+        data = self._xor(nonce, value.encode('utf-8'))
+        self.secrets[name] = {'nonce': base64.b64encode(nonce).decode('ascii'),
+                              'data': base64.b64encode(data).decode('ascii'),
+                              'mac': base64.b64encode(self._mac(name, nonce, data)).decode('ascii')}
+
+    def get(self, name):
+        entry = self.secrets.get(name)
+        if entry is None:
+            raise ConfigError('secret %s not found in %s' % (name, self.path))
+        nonce, data = base64.b64decode(entry['nonce']), base64.b64decode(entry['data'])
+        if not hmac.compare_digest(self._mac(name, nonce, data), base64.b64decode(entry['mac'])):
+            raise ConfigError('secret %s in %s failed verification' % (name, self.path))
+        return self._xor(nonce, data).decode('utf-8')
+
+    def remove(self, name):
+        if self.secrets.pop(name, None) is None:
+            raise ConfigError('secret %s not found in %s' % (name, self.path))
+
+
+# 类似ssh-agent: 解锁一次后派生出的密钥留在一个后台进程里，ttl 秒后自动退出。每次查询都重新读密码库文件，
+# 解锁后再 set 的密码也能取到。之后的登录和批量执行通过socket取密码，不用再输入主密码、再算一次scrypt
+class SecretAgent:
+    def __init__(self, store, ttl=3600):
+        self.store = store
+        self.expires = time.time() + ttl
+        self.uid = os.getuid()
+
+    def start(self, socket_path):
+        server = bind_unix_socket(socket_path)
+        pid = os.fork()
+        if pid:
+            server.close()
+            return pid
+        try:
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            serve_unix_socket(server, socket_path, self.handle, lambda: self.expires)
+        finally:
+            os._exit(0)
+
+    def handle(self, conn, request):
+        import socket
+        if hasattr(socket, 'SO_PEERCRED'):  # socket已经是0600，这里再确认一下对方是同一个用户
+            pid, uid, gid = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                                struct.calcsize('3i')))
+            if uid != self.uid:
+                return 'err permission denied\n'
+        command, _, name = request.partition(' ')
+        if command == 'get':
+            try:
+                value = self.store.load().get(name)
+            except ConfigError as e:
+                return 'err %s\n' % e
+            return 'ok %s\n' % base64.b64encode(value.encode('utf-8')).decode('ascii')
+        if command == 'status':
+            return 'ok %d\n' % max(self.expires - time.time(), 0)
+        if command == 'lock':
+            self.expires = 0
+            return 'ok\n'
+        return 'err unknown request %s\n' % command
 
 
 class SSHGO:
@@ -44,6 +1134,14 @@ class SSHGO:
 
     KEY_j = 106
     KEY_k = 107
+    KEY_w = 119
+    KEY_x = 120
+    KEY_0 = 48
+    KEY_9 = 57
+    KEY_p = 112
+    KEY_l = 108
+    KEY_TAB = 9
+    KEY_SESSION = 29  # Ctrl-]，会话中按它回到主机列表，主机列表中按它回到刚才的会话
 
     KEY_SPLASH = 47
     KEY_LEFT = 260
@@ -59,15 +1157,88 @@ class SSHGO:
     top_right = None   # 也用于右侧scroll bar
     bottom_right = None   # 也用于右侧scroll bar
     search_keyword = None
+    search_mode = 'regex'
+    SEARCH_MODES = ('regex', 'substring', 'fuzzy')
+    REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+    _search_leaves = None  # 搜索索引，首次搜索时建立
+    _search_trigrams = None
+    _trigram_thread = None
+    _search_cache = None  # (mode, keyword, 结果节点, 结果叶子id)
     line_number = 0
+    render_stats = None  # 累计渲染统计: 帧数, 写入的字符格数和字节数
+    frame_cells = 0
+    frame_bytes = 0
+    _screen_size = None
+    _rendered_rows = None
+    _marker_row = None
     config = None
-    host_title_list = set()
-    pre_host_list = set()
-
-    def __init__(self, config_file):
-
+    config_file = None
+    inventory_files = None  # 已经读取过的配置文件(主配置文件或目录、include的文件) -> 读取前的(mtime, size)
+    reload_interval = 1  # 主循环里每隔几秒检查一次配置文件有没有变化，0表示不检查
+    _reload_checked = 0
+    status_message = None  # 显示在第一行的提示，按任意键后消失
+    sessions = ()  # 后台会话，最近使用的在前
+    record_dir = None  # --record: 会话录像保存的目录
+    record_max_size = 64 << 20
+    record_keep = 5
+    persist_state = True  # 退出时保存展开的组、光标和上一次搜索，下次启动时恢复
+    last_search = None  # (搜索模式, 关键字)，搜索框里按上方向键调出
+    secrets_file = None  # 密码库文件，默认 ~/.config/sshgo/secrets.json
+    _secret_values = None  # name -> 明文，同一个进程里只取一次
+    _secret_store = None  # 没有agent时本进程自己解锁的密码库
+    visible = None  # 当前可见行的扁平索引，按行号顺序保存节点
+    title_index = None  # title -> node
+    pre_host_list = None
+    unloaded_groups = None  # 还没有加载子节点的 LazyGroupNode
+    _login_chain_cache = None  # title -> (起始节点, 合并去重后的expect列表)
+    ssh_command = None
+    multiplex = False
+    control_persist = '10m'
+    _warm_checked = None  # ControlPath -> (检查时间, master是否可以连接)
+    _control_dir = None
+    _control_paths = None  # ssh参数 -> ControlPath，界面每帧都要用，不每次都建目录和算sha1
+    batch_parallel = 20  # 批量执行时同时连接的主机数
+    batch_timeout = 30  # 批量执行时每台主机的超时(秒)
+    login_step_timeout = 30  # 登录时等待每一个提示符的超时(秒)，0表示不限制
+    login_timeout = 120  # 整个登录过程的超时(秒)，0表示不限制
+    trace_login = False
+    last_connect = None  # title -> 最近一次登录的耗时，--show-connect-time 时才加载
+    usage = None  # UsageCache
+    recent_size = 10
+    recent_group = None  # 树顶部的"recent"虚拟组，子节点是常用主机的副本，不在title_index和搜索索引里
+    prober = None  # 后台探测主机可达性，--probe 或按 p 时创建
+    probe_ttl = 300
+    probe_banner = False
+    latency_view = None  # None: 树形; 'sort': 所有主机按延迟排序; 'up': 只显示可达的主机
+    LATENCY_VIEWS = (None, 'sort', 'up')
+    _latency_cache = None  # (视图, 探测结果版本, 主机数, 行列表)
+    _probe_targets = None  # ssh参数 -> (host, port)
+
+    def __init__(self, config_file, search_mode='regex', use_cache=True, ssh_command=None, multiplex=True,
+                 control_persist='10m', recent_size=10):
+
+        self.search_mode = search_mode
+        self.use_cache = use_cache
+        self.ssh_command = ssh_command
+        self.multiplex = multiplex
+        self.control_persist = control_persist
+        self._warm_checked = {}
+        self._control_paths = {}
+        self.startup_profile = []
+        self._profile_time = START_TIME
+        self.profile_mark('import')
         self._parse_config_file(config_file)
+        self.recent_size = recent_size
+        if recent_size:
+            self.usage = UsageCache(os.path.join(cache_dir(), 'recent.json'))
+            self._refresh_recent()
+        self.render_stats = {'frames': 0, 'cells': 0, 'bytes': 0}
+        self.sessions = []
+        self.top_line_number = 0
+        self.highlight_line_number = 0
 
+    # 初始化curses并进入主循环
+    def start(self):
         self.screen = curses.initscr()
         curses.noecho()
         curses.cbreak()
@@ -75,9 +1246,6 @@ class SSHGO:
         self.screen.keypad(1)
         self.screen.border(0)
 
-        self.top_line_number = 0
-        self.highlight_line_number = 0
-
         curses.start_color()
         curses.use_default_colors()
 
@@ -99,28 +1267,50 @@ class SSHGO:
         # black bg
         curses.init_pair(6, curses.COLOR_BLACK, curses.COLOR_BLACK)
         self.COLOR_BBG = 6
+        self.profile_mark('curses init')
+        if self.persist_state:
+            self.restore_state()
+            self.profile_mark('restore state')
 
         self.run()
+        if self.persist_state:
+            self.save_state()
 
     def run(self):
+        last_key = None
         try:
             while True:
+                if self.reload_interval and time.time() - self._reload_checked >= self.reload_interval:
+                    self._reload_checked = time.time()
+                    self.reload_config()
                 self.render_screen()
-                c = self.screen.getch()
+                if self.render_stats['frames'] == 1:
+                    self.profile_mark('first frame')
+                if self.status_message is not None:
+                    self._show_status(self.status_message)
+                # 探测进行中时getch定时返回，让新的探测结果能显示出来；否则定时返回检查配置文件有没有变化
+                if self.prober is not None and self.prober.pending:
+                    c = self._getch(200)
+                else:
+                    c = self._getch(int(self.reload_interval * 1000) if self.reload_interval else -1)
+                if c != -1:
+                    self.status_message = None
                 if c == curses.KEY_UP or c == self.KEY_k:
                     self.updown(-1)
                 elif c == curses.KEY_DOWN or c == self.KEY_j:
                     self.updown(1)
                 elif c == self.KEY_u:  # 上翻页
-                    for i in range(0, curses.tigetnum('lines')):
-                        self.updown(-1)
+                    self.page(self.UP)
                 elif c == self.KEY_d:  # 下翻页
-                    for i in range(0, curses.tigetnum('lines')):
-                        self.updown(1)
+                    self.page(self.DOWN)
                 elif c == self.KEY_ENTER or c == self.KEY_SPACE or c == self.KEY_RIGHT:
                     self.toggle_node()
                 elif c == self.KEY_ESC or c == self.KEY_q:
-                    self.exit()
+                    if len(self.sessions) and self.search_keyword is None and last_key != c:
+                        self.status_message = '%d session(s) still open, press %s again to close them and quit' % (
+                            len(self.sessions), 'q' if c == self.KEY_q else 'Esc')
+                    else:
+                        self.exit()
                 elif c == self.KEY_O or c == self.KEY_M:
                     self.open_all()
                 elif c == self.KEY_o or c == self.KEY_m:
@@ -139,73 +1329,494 @@ class SSHGO:
                     self.page_bottom()
                 elif c == self.KEY_SPLASH:
                     self.enter_search_mode()
+                elif c == self.KEY_w:
+                    self.prewarm()
+                elif c == self.KEY_x:
+                    self.exec_on_current()
+                elif self.KEY_0 <= c <= self.KEY_9:
+                    self.connect_recent((c - self.KEY_0 - 1) % 10)  # 1 是第一个，0 是第十个
+                elif c == self.KEY_p:
+                    self.start_probe(True)
+                elif c == self.KEY_l:
+                    self.latency_view = self.LATENCY_VIEWS[(self.LATENCY_VIEWS.index(self.latency_view) + 1)
+                                                           % len(self.LATENCY_VIEWS)]
+                    self.page_top()
+                elif c == self.KEY_SESSION:
+                    self.switch_session(0)
+                elif c == self.KEY_TAB:
+                    self.switch_session(1)
+                if c != -1:
+                    last_key = c
         except SystemExit:
             pass
+        except ConfigError as e:  # 延迟加载的配置文件有错误
+            self.restore_screen()
+            print('\033[1;31;40m %s\033[0m' % e)
         except:
             self.screen.keypad(0)
             self.restore_screen()
+            import traceback
             traceback.print_exc()   # 使用curses情况下异常堆栈跟踪
+        finally:
+            self.close_sessions()  # 不管怎么退出，后台会话都要关掉，录像要写完
+
+    def profile_mark(self, phase):
+        now = time.perf_counter()
+        self.startup_profile.append((phase, now - self._profile_time))
+        self._profile_time = now
 
     def _parse_config_file(self, config_file):
+        # 加载时会一次性创建大量对象，期间关闭gc，避免反复触发分代回收
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        self.config_file = config_file
+        self.inventory_files = {config_file: file_signature(config_file)}
+        try:
+            if os.path.isdir(config_file):
+                self._load_config_dir(config_file)
+            else:
+                self._load_config_file(config_file)
+        except ConfigError as e:
+            print('\033[1;31;40m %s\033[0m' % e)
+            sys.exit(1)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _reset_inventory(self):
+        self.title_index = {}
+        self._probe_targets = {}
+        self.pre_host_list = set()
+        self.unloaded_groups = set()
+        self.line_number = 0
+        self._search_leaves = None
+
+    # 配置目录: 目录下每个 .json/.jsonl 文件是一个顶层组，只读取文件头，展开时才解析
+    def _load_config_dir(self, config_dir):
+        self._login_chain_cache = {}
+        self._reset_inventory()
+        config = self._config_dir_nodes(config_dir)
+        self.profile_mark('read headers')
+        self.config = self.handle_node(None, config, 0, config_dir)
+        self._check_config()
+        self._rebuild_visible()
+        self.profile_mark('handle_node')
+
+    @staticmethod
+    def _config_dir_nodes(config_dir):
+        config = []
+        for name in sorted(os.listdir(config_dir)):
+            if not name.endswith('.json') and not name.endswith('.jsonl'):
+                continue
+            header = read_inventory_header(os.path.join(config_dir, name))
+            config.append({'title': header.get('title', os.path.splitext(name)[0]), 'include': name,
+                           'count': header.get('count'), 'expanded': header.get('expanded', False)})
+        return config
+
+    def _load_config_file(self, config_file):
+        self._login_chain_cache = {}
+        stat = os.stat(config_file)
+        cache_file = cache_file_for(config_file, 'inventory') if self.use_cache else None
+        text = self._load_inventory_cache(cache_file, config_file, stat)
+        if text is None:
+            return
 
-        f = open(config_file, 'r')
-        text = f.read()
-        f.close()
-        self.config = json.loads(text)
+        config = json.loads(text)
+        self._reset_inventory()
+        self.profile_mark('json parse')
 
         # 开始解析json配置文件:
-        self.handle_node(None, self.config, 0)
+        self.config = self.handle_node(None, config, 0, os.path.dirname(os.path.abspath(config_file)))
+        self.profile_mark('handle_node')
 
         # 检查配置文件是否正常
-        not_found_pre_host_list = self.pre_host_list - self.host_title_list
-        if len(not_found_pre_host_list):
-            print('\033[1;31;40m pre_host %s not found!\033[0m' % not_found_pre_host_list)
-            sys.exit(1)
-
-    def handle_node(self, parent, nodes, level):
+        self._check_config()
+        self.profile_mark('validate')
+
+        # 缓存只包含主配置文件里的节点，必须在展开include的组之前写入
+        if cache_file is not None:
+            header = (INVENTORY_CACHE_VERSION, stat.st_mtime_ns, stat.st_size,
+                      hashlib.sha1(text.encode('utf-8')).hexdigest())
+            self._save_inventory_cache(cache_file, header)
+            self.profile_mark('cache write')
+        self._rebuild_visible()
+
+    def _check_config(self):
+        not_found_pre_host_list = self.pre_host_list - self.title_index.keys()
+        if len(not_found_pre_host_list) and not len(self.unloaded_groups):
+            raise ConfigError('pre_host %s not found!' % not_found_pre_host_list)
+        self._check_pre_host_chains()
+
+    def load_group(self, node):
+        if node.include is None:
+            return
+        path = node.include
+        self.inventory_files[path] = file_signature(path)
+        # 先解析到临时的索引里(重复的title仍然和已有的比较)，整个文件都没有问题才登记。
+        # 否则文件中间某一行出错时前面的节点已经进了title_index，改好文件后再加载会报title重复
+        saved = (self.title_index, self.pre_host_list, self.unloaded_groups, self.line_number)
+        added = {}
+        self.title_index = collections.ChainMap(added, saved[0])
+        self.pre_host_list = set()
+        self.unloaded_groups = set()
+        try:
+            sub_node = self.handle_node(node, read_inventory_file(path), node.level + 1, os.path.dirname(path))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.line_number = saved[3]
+            raise ConfigError('cannot load "%s" for group "%s": %s' % (path, node.title, e))
+        except ConfigError:
+            self.line_number = saved[3]
+            raise
+        finally:
+            pre_hosts, unloaded = self.pre_host_list, self.unloaded_groups
+            self.title_index, self.pre_host_list, self.unloaded_groups = saved[:3]
+        self.title_index.update(added)
+        self.pre_host_list |= pre_hosts
+        self.unloaded_groups |= unloaded
+        node.include = None
+        node.sub_node = sub_node
+        self.unloaded_groups.discard(node)
+        self._search_leaves = None  # 搜索索引需要重建
+        self._check_config()
+        if self.prober is not None:
+            self.prober.probe(self._probe_targets_under(sub_node))
+
+    def load_all_groups(self):
+        while len(self.unloaded_groups):
+            self.load_group(next(iter(self.unloaded_groups)))
+
+    # 编译缓存: 第一段pickle是头部(版本, mtime, size, sha1)，第二段是解析好的树和索引。
+    # 命中时直接返回None，未命中时返回配置文件的内容供后续解析。
+    def _load_inventory_cache(self, cache_file, config_file, stat):
+        text = None
+        try:
+            if cache_file is None:
+                raise OSError
+            with open(cache_file, 'rb') as f:
+                header = pickle.load(f)
+                if header[0] != INVENTORY_CACHE_VERSION:
+                    raise ValueError
+                if header[1:3] != (stat.st_mtime_ns, stat.st_size):
+                    # 文件被touch过或者被原样覆盖，内容没变的话缓存依然可用
+                    with open(config_file, 'r') as config:
+                        text = config.read()
+                    if hashlib.sha1(text.encode('utf-8')).hexdigest() != header[3]:
+                        raise ValueError
+                self._load_inventory_columns(pickle.load(f))
+            self.profile_mark('cache load')
+            if text is not None:
+                self._save_inventory_cache(cache_file, (INVENTORY_CACHE_VERSION, stat.st_mtime_ns, stat.st_size,
+                                                        header[3]))
+            return None
+        except (OSError, ValueError, EOFError, IndexError, TypeError, pickle.UnpicklingError):
+            pass
+        self.profile_mark('cache lookup')
+        if text is None:
+            with open(config_file, 'r') as f:
+                text = f.read()
+            self.profile_mark('read')
+        return text
+
+    def _save_inventory_cache(self, cache_file, header):
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self._inventory_columns(), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass  # 缓存只是加速用的，写不了也不影响使用
+
+    # 缓存里按列保存先序排列的节点属性，加载时一次循环就能重建树、title索引和可见行
+    def _inventory_columns(self):
+        nodes = sorted(self.title_index.values(), key=lambda n: n.line_number)
+        return (tuple(n.title for n in nodes), tuple(n.ssh for n in nodes), tuple(n.pre_host for n in nodes),
+                tuple(n.expect for n in nodes), tuple(n.expanded for n in nodes), tuple(n.level for n in nodes),
+                tuple(n.is_group for n in nodes), tuple(n.include for n in nodes),
+                tuple(n.count if n.include is not None else None for n in nodes))
+
+    def _load_inventory_columns(self, columns):
+        titles, sshs, pre_hosts, expects, expandeds, levels, is_groups, includes, counts = columns
+        self._reset_inventory()
+        new = object.__new__
+        config = []
+        nodes = []
+        groups = []  # groups[level] 为当前路径上第level层的组
+        for i in range(len(titles)):
+            level = levels[i]
+            parent = groups[level - 1] if level else None
+            if includes[i] is not None:
+                node = new(LazyGroupNode)
+                node.sub_node = []
+                node.include = node.source = includes[i]
+                node.count = counts[i]
+                self.unloaded_groups.add(node)
+            elif is_groups[i]:
+                node = new(GroupNode)
+                node.sub_node = []
+                del groups[level:]
+                groups.append(node)
+            else:
+                node = new(HostNode)
+            node.title = titles[i]
+            node.ssh = sshs[i]
+            node.pre_host = pre_hosts[i]
+            node.expect = expects[i]
+            node.expanded = expandeds[i]
+            node.parent = parent
+            node.level = level
+            node.line_number = i + 1
+            (parent.sub_node if parent is not None else config).append(node)
+            nodes.append(node)
+        self.config = config
+        self.title_index.update(zip(titles, nodes))
+        self.pre_host_list.update(title for title in pre_hosts if title is not None)
+        self.line_number = len(titles)
+        self._rebuild_visible()
+
+    def _check_pre_host_chains(self):
+        checked = set()
+        for title in self.title_index:
+            chain = []
+            node = self.title_index[title]
+            while node.pre_host is not None and node.title not in checked:
+                if node.title in chain:
+                    raise ConfigError('pre_host cycle found: %s!'
+                                      % ' -> '.join(chain[chain.index(node.title):] + [node.title]))
+                chain.append(node.title)
+                if node.pre_host not in self.title_index:
+                    break  # pre_host 在还没加载的组里，加载之后再检查
+                node = self.title_index[node.pre_host]
+            if node.pre_host is None and node.ssh is None and len(chain):
+                raise ConfigError('pre_host "%s" of "%s" has no field "ssh"!' % (node.title, chain[-1]))
+            if node.pre_host is None or node.pre_host in self.title_index:
+                checked.update(chain)
+
+    # 把json里的节点转换成 GroupNode/HostNode/LazyGroupNode，同时检查配置文件是否正常
+    def handle_node(self, parent, nodes, level, base_dir):
+        rt = []
         for anode in nodes:
             # 检查配置文件是否正常
-            if anode['title'] in self.host_title_list:
-                print('\033[1;31;40m title"%s"repeated in config file!\033[0m' % (anode['title']))
-                sys.exit(1)
-            if 'ssh' not in anode and 'pre_host' not in anode and 'sub_node' not in anode:
-                print('\033[1;31;40m'
-                      'Node "%s" must contains field "ssh" or "pre_host" or "sub_node" in config file!\033[0m'
-                      % (anode['title']))
-                sys.exit(1)
+            if anode['title'] in self.title_index:
+                raise ConfigError('title"%s"repeated in config file!' % (anode['title']))
+            if 'ssh' not in anode and 'pre_host' not in anode and 'sub_node' not in anode and 'include' not in anode:
+                raise ConfigError('Node "%s" must contains field "ssh" or "pre_host" or "sub_node" or "include" '
+                                  'in config file!' % (anode['title']))
 
-            self.host_title_list.add(anode['title'])
             self.line_number += 1
-            if 'sub_node' not in anode:
-                anode['sub_node'] = []
-            if 'expanded' not in anode:
-                anode['expanded'] = False
-            if 'pre_host' in anode:
-                self.pre_host_list.add(anode['pre_host'])
-            if 'expect' not in anode:
-                anode['expect'] = []
-            anode['parent'] = parent
-            anode['level'] = level
-            anode['line_number'] = self.line_number
-            if len(anode['sub_node']):
-                self.handle_node(anode, anode['sub_node'], level + 1)
+            if 'include' in anode:
+                node_class = LazyGroupNode
+            elif len(anode.get('sub_node', ())):
+                node_class = GroupNode
+            else:
+                node_class = HostNode
+            node = node_class(anode['title'], anode.get('ssh'), anode.get('pre_host'),
+                              tuple(anode['expect']) if len(anode.get('expect', ())) else Node.NO_EXPECT,
+                              anode.get('expanded', False), parent, level, self.line_number)
+            self.title_index[node.title] = node
+            if node.pre_host is not None:
+                self.pre_host_list.add(node.pre_host)
+            if node_class is LazyGroupNode:
+                node.sub_node = []
+                node.include = node.source = os.path.join(base_dir, os.path.expanduser(anode['include']))
+                node.count = anode.get('count', read_inventory_header(node.include).get('count'))
+                self.unloaded_groups.add(node)
+            elif node_class is GroupNode:
+                node.sub_node = self.handle_node(node, anode['sub_node'], level + 1, base_dir)
+            rt.append(node)
+        return rt
 
-    # zssh 远程登录
-    def do_ssh(self, node):
+    # 热加载: 配置文件(或目录、已经加载的include文件)有变化时，按title把新配置和现在的树对比，
+    # 自身配置没变的节点直接复用(连同展开状态和子树)，只为变化的部分创建新节点。解析出错时保留原来的树
+    def changed_inventory_files(self):
+        return set(path for path, signature in self.inventory_files.items() if file_signature(path) != signature)
+
+    def reload_config(self):
+        changed = self.changed_inventory_files()
+        if not len(changed):
+            return False
+        cursor = self._cursor_path()
+        saved = (self.title_index, self.pre_host_list, self.unloaded_groups, self.inventory_files, self.line_number)
+        old_index = saved[0]
+        self.title_index = {}
+        self.pre_host_list = set()
+        self.unloaded_groups = set()
+        self.inventory_files = {self.config_file: file_signature(self.config_file)}
+        children = {}  # 复用的组 -> 新的子节点列表，全部检查通过后才替换
+        try:
+            if self.config_file not in changed:
+                config = list(self.config)
+                self._adopt(config, old_index, changed, children, saved[3])
+            elif os.path.isdir(self.config_file):
+                config = self._reconcile(None, self._config_dir_nodes(self.config_file), 0, self.config_file,
+                                         old_index, changed, children, saved[3])
+            else:
+                with open(self.config_file, 'r') as f:
+                    nodes = json.load(f)
+                config = self._reconcile(None, nodes, 0, os.path.dirname(os.path.abspath(self.config_file)),
+                                         old_index, changed, children, saved[3])
+            self._check_config()
+        except (OSError, ValueError, KeyError, ConfigError) as e:
+            self.title_index, self.pre_host_list, self.unloaded_groups, self.inventory_files, self.line_number = saved
+            for path in changed:  # 文件再次修改之前不再重试
+                self.inventory_files[path] = file_signature(path)
+            self.status_message = 'reload failed: %s' % e
+            return False
+        for group, sub_node in children.items():
+            group.sub_node = sub_node
+        self.config = config
+        self._renumber()
+        self._login_chain_cache = {}
+        self._search_leaves = None
+        self._search_cache = None
+        self._latency_cache = None
+        self._probe_targets = {}
+        self._rebuild_visible()
+        if self.usage is not None:
+            self._refresh_recent()
+        self._restore_cursor(cursor)
+        if self.prober is not None:
+            self.prober.probe(self._probe_targets_under(self.config))
+        self.status_message = 'reloaded %s' % ', '.join(sorted(os.path.basename(path) for path in changed))
+        return True
+
+    # 节点自身的配置(不含子节点)没有变化时可以复用
+    @staticmethod
+    def _same_node(node, anode, base_dir):
+        if 'include' in anode:
+            if not isinstance(node, LazyGroupNode) or \
+                    node.source != os.path.join(base_dir, os.path.expanduser(anode['include'])):
+                return False
+        elif len(anode.get('sub_node', ())):
+            if type(node) is not GroupNode:
+                return False
+        elif node.is_group:
+            return False
+        return (node.ssh, node.pre_host, node.expect) == (anode.get('ssh'), anode.get('pre_host'),
+                                                          tuple(anode.get('expect', ())))
+
+    def _reconcile(self, parent, nodes, level, base_dir, old_index, changed, children, old_files):
+        rt = []
+        for anode in nodes:
+            old = old_index.get(anode['title'])
+            if old is None or not self._same_node(old, anode, base_dir):
+                node = self.handle_node(parent, [anode], level, base_dir)[0]
+                if old is not None and old.is_group and node.is_group:
+                    node.expanded = old.expanded
+                rt.append(node)
+                continue
+            self._register(old)
+            if isinstance(old, LazyGroupNode):
+                self._reconcile_include(old, old_index, changed, children, old_files)
+            elif old.is_group:
+                children[old] = self._reconcile(old, anode['sub_node'], level + 1, base_dir, old_index, changed,
+                                                children, old_files)
+            rt.append(old)
+        return rt
+
+    # 配置没变的子树整个复用，只需要重新登记title，里面的include文件变了的话再对比那个文件
+    def _adopt(self, nodes, old_index, changed, children, old_files):
+        for node in nodes:
+            self._register(node)
+            if isinstance(node, LazyGroupNode):
+                self._reconcile_include(node, old_index, changed, children, old_files)
+            elif node.is_group:
+                self._adopt(node.sub_node, old_index, changed, children, old_files)
+
+    def _register(self, node):
+        if node.title in self.title_index:
+            raise ConfigError('title"%s"repeated in config file!' % node.title)
+        self.title_index[node.title] = node
+        if node.pre_host is not None:
+            self.pre_host_list.add(node.pre_host)
+
+    def _reconcile_include(self, node, old_index, changed, children, old_files):
+        path = node.source
+        if node.include is not None:
+            self.unloaded_groups.add(node)
+        elif path not in changed:
+            self.inventory_files[path] = old_files[path]
+            self._adopt(node.sub_node, old_index, changed, children, old_files)
+        else:
+            self.inventory_files[path] = file_signature(path)
+            try:
+                nodes = list(read_inventory_file(path))
+            except (OSError, ValueError) as e:
+                raise ConfigError('cannot load "%s" for group "%s": %s' % (path, node.title, e))
+            children[node] = self._reconcile(node, nodes, node.level + 1, os.path.dirname(path), old_index, changed,
+                                             children, old_files)
+
+    # 先序重新设置 parent/level/line_number，复用的节点可能被移动到了别的组下
+    def _renumber(self):
+        self.line_number = 0
+        stack = [(node, None, 0) for node in reversed(self.config)]
+        while len(stack):
+            node, parent, level = stack.pop()
+            self.line_number += 1
+            node.parent = parent
+            node.level = level
+            node.line_number = self.line_number
+            if node.is_group:
+                stack.extend((child, node, level + 1) for child in reversed(node.sub_node))
+
+    # 当前行和它所有上级的title，以及它在屏幕上的位置
+    def _cursor_path(self):
+        lines = self.get_lines()
+        row = self.current_row()
+        return self._title_path(lines[row]) if row < len(lines) else [], self.highlight_line_number
+
+    # 重新加载后光标回到原来的节点并保持在屏幕上的位置。节点被移到别的组下时展开它新的上级，
+    # 节点被删除时定位到最近的还存在的上级
+    def _restore_cursor(self, cursor):
+        path, screen_row = cursor
+        lines = self.get_lines()
+        row = None
+        for i, node in enumerate(lines):
+            if len(path) and node.title == path[0] and self._title_path(node) == path:
+                row = i
+                break
+        node = self.title_index.get(path[0]) if row is None and len(path) else None
+        if node is not None and self.tree_view():
+            parent, collapsed = node.parent, False
+            while parent is not None:
+                collapsed = collapsed or not parent.expanded
+                parent.expanded = True
+                parent = parent.parent
+            if collapsed:
+                self._rebuild_visible()
+            row = self._visible_row(node)
+        elif node is not None:
+            row = next((i for i, line in enumerate(lines) if line is node), None)
+        for title in path[1:] if row is None else ():
+            row = next((i for i, node in enumerate(lines) if node.title == title), None)
+            if row is not None:
+                break
+        row = 0 if row is None else row
+        self.top_line_number = max(row - screen_row, 0)
+        self.move_to(row)
+
+    @staticmethod
+    def _title_path(node):
+        path = []
+        while node is not None:
+            path.append(node.title)
+            node = node.parent
+        return path
+
+    # 解析 pre_host 跳转链，得到起始节点和合并后的expect列表，结果按title缓存
+    def resolve_login_chain(self, node):
+        if node.title in self._login_chain_cache:
+            return self._login_chain_cache[node.title]
         expect_list = []
         begin_node = node
-        while 'pre_host' in begin_node:
-            expect_list = begin_node['expect'] + expect_list
-            pre_node_title = begin_node['pre_host']
-            stack = self.config + []
-            while len(stack):
-                anode = stack.pop()
-                if anode['title'] == pre_node_title:
-                    begin_node = anode
-                    break
-                if len(anode['sub_node']):
-                    stack = stack + anode['sub_node']
-        expect_list = begin_node['expect'] + expect_list
+        while begin_node.pre_host is not None:
+            expect_list = list(begin_node.expect) + expect_list
+            if begin_node.pre_host not in self.title_index:
+                self.load_all_groups()  # pre_host 可能在还没有加载的组里
+                if begin_node.pre_host not in self.title_index:
+                    raise ConfigError('pre_host %s not found!' % begin_node.pre_host)
+            begin_node = self.title_index[begin_node.pre_host]
+        expect_list = list(begin_node.expect) + expect_list
         # 删除重复的setTitle,ps1等只保留最后一个
         expect_repeat_flag = {'setTitle': False, 'ps1': False}
         for i in range(len(expect_list) - 1, -1, -1):
@@ -216,99 +1827,765 @@ class SSHGO:
                     else:
                         del expect_list[i]
                 break  # 每个expect应只有一个键值对,多余的忽略掉.
+        self._login_chain_cache[node.title] = (begin_node, expect_list)
+        return begin_node, expect_list
+
+    # 实际登录时的expect列表: 复用已有连接时不会再提示输入起始主机的密码
+    def login_steps(self, node):
+        begin_node, expect_list = self.resolve_login_chain(node)
+        if self.is_warm(node, True):
+            expect_list = [expect for expect in expect_list
+                           if not (is_auth_step(expect) and any(expect is e for e in begin_node.expect))]
+        return begin_node, expect_list
+
+    # 取密码库里的密码: 先找本进程的缓存，再问agent，都没有时在终端上输入主密码解锁(interactive 为 False 时报错)
+    def secret(self, name, interactive=True):
+        if self._secret_values is None:
+            self._secret_values = {}
+        if name in self._secret_values:
+            return self._secret_values[name]
+        path = self.secrets_file or secrets_file_default()
+        try:
+            value = base64.b64decode(agent_request(agent_socket_for(path), 'get ' + name)).decode('utf-8')
+        except OSError:  # 没有运行agent
+            if self._secret_store is None:
+                if not interactive:
+                    raise ConfigError('secret store is locked, run "%s secret unlock"' % sys.argv[0])
+                self._secret_store = SecretStore(path).load().prompt_unlock()
+            value = self._secret_store.get(name)
+        self._secret_values[name] = value
+        return value
+
+    def expand_secrets(self, value, interactive=True):
+        if not isinstance(value, str) or '${secret:' not in value:
+            return value
+        return SECRET_PATTERN.sub(lambda match: self.secret(match.group(1), interactive), value)
+
+    # 替换expect里的 ${secret:NAME}，返回新的列表，不改配置里的节点(也就不会进缓存)；
+    # 替换过的expect是新的dict，owners 里补上它属于哪台主机
+    def resolve_secrets(self, expect_list, owners, interactive=True):
+        resolved = []
+        for expect in expect_list:
+            if any(isinstance(value, str) and '${secret:' in value for value in expect.values()):
+                copy = dict((key, self.expand_secrets(value, interactive)) for key, value in expect.items())
+                owners[id(copy)] = owners.get(id(expect), '')
+                expect = copy
+            resolved.append(expect)
+        return resolved
+
+    # 命令行模式下按title或搜索关键字找主机: 完整的title直接查索引，否则按 search_mode 搜索
+    def match_hosts(self, pattern):
+        if pattern not in self.title_index and len(self.unloaded_groups):
+            self.load_all_groups()
+        if pattern in self.title_index:
+            return self._leaves_under(self.title_index[pattern])
+        self.search_keyword = pattern
+        try:
+            return [node for node in self._search_node() if not node.is_group]
+        finally:
+            self.search_keyword = None
+
+    def host_path(self, node):
+        path = []
+        while node.parent is not None:
+            node = node.parent
+            path.append(node.title)
+        return '/'.join(reversed(path))
+
+    # 补全索引包含所有的组和主机，需要先加载所有include的文件
+    def write_completion_index(self, index_file):
+        self.load_all_groups()
+        lines = sorted('%s\t%s\n' % (node.title, self.host_path(node)) for node in self.title_index.values()
+                       if '\t' not in node.title and '\n' not in node.title)
+        deps = ''.join(os.path.abspath(path) + '\n' for path in self.inventory_files)
+        for path, text in ((index_file + '.deps', deps), (index_file, ''.join(lines))):  # 先写deps，索引最后写
+            tmp_file = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_file, 'w') as f:
+                f.write(text)
+            os.replace(tmp_file, path)
+
+    def find_node(self, title):
+        if title not in self.title_index:
+            self.load_all_groups()
+        if title not in self.title_index:
+            raise ConfigError('host or group "%s" not found!' % title)
+        return self.title_index[title]
+
+    def ssh_command_line(self, begin_node, master='auto', extra=''):
+        ssh = self.ssh_command
+        if ssh is None:
+            ssh = 'zssh' if shutil.which('zssh') is not None else 'ssh'
+        if self.multiplex:
+            ssh += ' -o ControlMaster=%s -o ControlPath=%s -o ControlPersist=%s' % (
+                master, self.control_path(begin_node.ssh), self.control_persist)
+        return ssh + extra + ' ' + begin_node.ssh
+
+    def control_path(self, ssh_param):
+        path = self._control_paths.get(ssh_param)
+        if path is None:
+            if not len(self._control_paths):
+                self._control_dir = control_dir()
+            path = self._control_paths[ssh_param] = control_path_for(ssh_param, self._control_dir)
+        return path
+
+    # 起始主机是否已经有可复用的 ControlMaster 连接，结果缓存1秒，避免每帧都stat
+    # 界面每帧都会调用，不能加载include的文件: 跳转链经过还没有加载的组时当作没有连接。
+    # fresh 为 True 时不用缓存的结果，登录前决定要不要跳过密码步骤时用
+    def is_warm(self, node, fresh=False):
+        if not self.multiplex:
+            return False
+        begin_node = self._loaded_begin_node(node)
+        if begin_node is None:
+            return False
+        control_path = self.control_path(begin_node.ssh)
+        now = time.time()
+        checked = self._warm_checked.get(control_path)
+        if fresh or checked is None or now - checked[0] > 1:
+            checked = (now, os.path.exists(control_path) and control_master_alive(control_path))
+            self._warm_checked[control_path] = checked
+        return checked[1]
+
+    # 只在已经加载的节点里找跳转链的起始节点，找不到时返回None
+    def _loaded_begin_node(self, node):
+        if node.title in self._login_chain_cache:
+            return self._login_chain_cache[node.title][0]
+        seen = set()
+        while node.pre_host is not None:
+            if node.pre_host in seen or node.pre_host not in self.title_index:
+                return None
+            seen.add(node.pre_host)
+            node = self.title_index[node.pre_host]
+        return node
+
+    def _leaves_under(self, node):
+        if not node.is_group:
+            return [node]
+        rt = []
+        stack = [node]
+        while len(stack):
+            anode = stack.pop()
+            if anode.is_group:
+                self.load_group(anode)
+                stack.extend(reversed(anode.sub_node))
+            else:
+                rt.append(anode)
+        return rt
 
-        ssh_param = begin_node['ssh']
-        ssh = 'ssh'
-        if os.popen('which zssh 2> /dev/null').read().strip() != '':
-            ssh = 'zssh'
-        self.child = pexpect.spawn(ssh + ' ' + ssh_param, encoding='utf-8')
+    # 为当前组(或主机)下所有主机的起始跳板机预先建立 ControlMaster 连接
+    def prewarm(self):
+        visible_hosts = self.get_lines()
+        if not self.multiplex or not len(visible_hosts):
+            return
+        begin_nodes = {}
+        for leaf in self._leaves_under(visible_hosts[self.current_row()]):
+            try:
+                begin_node = self.resolve_login_chain(leaf)[0]
+            except ConfigError:
+                continue
+            control_path = self.control_path(begin_node.ssh)
+            if begin_node.ssh in begin_nodes or control_master_alive(control_path):
+                continue
+            try:
+                os.unlink(control_path)  # 残留的socket，ControlMaster=yes 时ssh不会覆盖它
+            except OSError:
+                pass
+            begin_nodes[begin_node.ssh] = begin_node
+        import_pexpect()
+        # 先全部启动，各个连接并行握手，再依次应答密码
+        children = [(begin_node, pexpect.spawn(self.ssh_command_line(begin_node, 'yes', ' -f -N'), encoding='utf-8'))
+                    for begin_node in begin_nodes.values()]
+        for i, (begin_node, child) in enumerate(children):
+            self._show_status('prewarming %d/%d: %s' % (i + 1, len(children), begin_node.title))
+            self._answer_auth(child, begin_node)
+        self._warm_checked = {}
+
+    def _answer_auth(self, child, begin_node):
+        try:
+            for expect in begin_node.expect:
+                if not is_auth_step(expect):
+                    continue
+                for key in expect:
+                    prompt = '[Pp]assword: |密码：' if key == 'passwd' else re.escape(key)
+                    while True:
+                        i = child.expect([pexpect.EOF, r'Are you sure you want to continue connecting \(yes/no',
+                                          prompt], timeout=30)
+                        if i == 1:  # SSH does not have the public key. Just accept it.
+                            child.sendline('yes')
+                            continue
+                        if i == 0:  # 不需要密码就认证成功了，或者连接失败
+                            child.close()
+                            return
+                        child.sendline(self.expand_secrets(expect[key], False))
+                        break
+                    break
+            # -f: 认证成功后ssh转到后台，前台进程退出；后台进程没关掉终端时等不到EOF，socket出现即可
+            control_path = self.control_path(begin_node.ssh)
+            deadline = time.time() + 30
+            while not os.path.exists(control_path):
+                if time.time() > deadline:
+                    raise pexpect.TIMEOUT('ControlMaster socket not created')
+                if child.expect([pexpect.EOF, pexpect.TIMEOUT], timeout=0.2) == 0:
+                    break
+            child.close(force=not os.path.exists(control_path))
+        except pexpect.TIMEOUT:
+            child.close(force=True)
+        except ConfigError as e:  # 界面里不能输入主密码，需要先 secret unlock
+            child.close(force=True)
+            self.status_message = str(e)
+
+    def _show_status(self, message):
+        screen_cols = self._screen_size[1]
+        self.screen.move(0, 0)
+        self.screen.clrtoeol()
+        self.screen.addstr(0, 0, message[:screen_cols - 1], curses.color_pair(self.COLOR_HIGHLIGHT))
+        self._rendered_rows[0] = ()
+        self.screen.refresh()
+
+    # zssh 远程登录
+    def do_ssh(self, node):
+        try:
+            begin_node, expect_list = self.login_steps(node)
+        except ConfigError as e:
+            self._login_error(e)
+            return
+        if self.usage is not None:
+            row = self.current_row()
+            recent_rows = self._recent_rows()
+            self.usage.touch(node.title)
+            self._refresh_recent()
+            if self.screen is not None and self.tree_view() and row >= recent_rows:  # recent组的行数变了，保持光标还在原来的主机上
+                self.move_to(row + self._recent_rows() - recent_rows)
+        session = self._find_session(node)
+        if session is not None:  # 已经连着，直接切换过去
+            self.resume_session(session)
+            return
+        owners = self._expect_owners(node)
+        try:
+            expect_list = self.resolve_secrets(expect_list, owners)
+        except ConfigError as e:  # 密码库里没有这一项、没有解锁或者解锁代理出错
+            self._login_error(e)
+            return
+        import_pexpect()
+        spawn_start = time.time()
+        self.child = pexpect.spawn(self.ssh_command_line(begin_node), encoding='utf-8')
+        spawn_time = time.time() - spawn_start
+        self.child.delaybeforesend = None  # pexpect 默认每次发送前sleep 50ms，每个登录步骤都要多等一次
         self.sigwinch_passthrough()
         signal.signal(signal.SIGINT, exit)  # 捕获Ctrl+C信号
         signal.signal(signal.SIGTERM, exit)  # 捕获Ctrl+C信号
         signal.signal(signal.SIGWINCH, self.sigwinch_passthrough_with_param)  # 捕获窗口大小调整信号
         self.child.logfile_read = sys.stdout  # 只将从远端读到的内容打印到屏幕
-        if len(expect_list):
-            for expect in expect_list:
-                for key in expect:
-                    if key == 'passwd':
-                        while True:
-                            i = self.child.expect([pexpect.EOF, pexpect.TIMEOUT,
-                                                   r'Are you sure you want to continue connecting \(yes/no',
-                                                   '[Pp]assword: ', '密码：', '[$#] '], timeout=-1)
-                            if i == 0:  # Exception
-                                input('\033[1;31;40mException occur and will exit!\033[0m')
-                                sys.exit(1)
-                            elif i == 1:  # Timeout
-                                input('\033[1;31;40mTimeout !\033[0m')
-                                sys.exit(1)
-                            elif i == 2:  # SSH does not have the public key. Just accept it.
-                                self.child.sendline('yes')
-                            elif i == 5:  # 用于提供了密码但是实际不需要输入密码就进去了的情况
-                                self.child.sendline(
-                                    '')  # 走到这里表示已经匹配了一次[$#]。配置文件中可能有下一步也是匹配[$#]的,故需要让流再次输出一次关键字$或#供下次匹配。
-                                break
-                            elif i == 3 or i == 4:
-                                self.child.sendline(expect[key])
-                                break
-                    elif key == 'ps1' or key == 'ps1-bench' or key == 'ps1-prod':
-                        self._make_sure_enter_bash()
-                        if key == 'ps1-prod':
-                            self.child.sendline("export PS1='\\[\\e[30;43m\\]" + expect[
-                                key] + ":\\w\\[\\e[33;45m\\]▶\\[\\e[37;45m\\]\\t \\$\\[\\e[0m\\]\\[\\e[35m\\]▶\\[\\e[0m\\]'")
-                        elif key == 'ps1-bench':
-                            self.child.sendline("export PS1='\\[\\e[30;42m\\]" + expect[
-                                key] + ":\\w\\[\\e[32;43m\\]▶\\[\\e[30;43m\\]\\t \\$\\[\\e[0m\\]\\[\\e[33m\\]▶\\[\\e[0m\\]'")
-                        else:  # key == 'ps1'
-                            self.child.sendline("export PS1='\\[\\e[30;46m\\]" + expect[
-                                key] + ":\\w\\[\\e[36;42m\\]▶\\[\\e[30;42m\\]\\t \\$\\[\\e[0m\\]\\[\\e[32m\\]▶\\[\\e[0m\\]'")
-                    elif key == 'setTitle':
-                        self._make_sure_enter_bash()
-                        title = expect[key] if expect[key] != '' else node['title']
-                        self.child.sendline("PROMPT_COMMAND='echo -ne \"\\033]0;" + title + "\\007\"'")  # 设置本地终端的标题
-                    else:
-                        # i = self.child.expect([pexpect.TIMEOUT, key],timeout=10)
-                        while True:
-                            i = self.child.expect_exact([pexpect.TIMEOUT,
-                                                         r'Are you sure you want to continue connecting (yes/no)?',
-                                                         key],
-                                                        timeout=-1)
-                            if i == 2:
-                                self.child.sendline(expect[key])
-                                break
-                            elif i == 1:  # SSH does not have the public key or key error. Just accept it.
-                                self.child.sendline('yes')
-                            elif i == 0:  # Timeout
-                                input('\033[1;31;40mTimeout! Cannot capture string "%s".\033[0m' % key)
-                                sys.exit(1)
+        recorder = None
+        if self.record_dir is not None:
+            recorder = TranscriptRecorder(self.record_dir, node.title, self.record_max_size, self.record_keep)
+        handshake = Handshake(expect_list, None, node.title, self.login_step_timeout, self.login_timeout, owners)
+        try:
+            replies, lines = handshake.feed('')
+            while True:
+                for reply in replies:
+                    self.child.sendline(reply)
+                if handshake.state == 'done':
+                    break
+                handshake.check_deadline()
+                try:
+                    data = self.child.read_nonblocking(65536, timeout=handshake.time_left())
+                except pexpect.TIMEOUT:
+                    replies = ()
+                    continue
+                if recorder is not None:
+                    recorder.write(data)
+                replies, lines = handshake.feed(data)
+        except pexpect.EOF:  # Exception
+            self.record_login(node, 'ssh', spawn_time, handshake, False, 'eof at ' + handshake.step_label())
+            self._login_failed(node, handshake, recorder, 'connection closed at ' + handshake.step_label())
+            return
+        except LoginTimeout as e:
+            self.record_login(node, 'ssh', spawn_time, handshake, False, str(e))
+            self._login_failed(node, handshake, recorder, 'Timeout! %s' % e)
+            return
+        self.record_login(node, 'ssh', spawn_time, handshake, True)
+        if self.trace_login:
+            self._print_login_trace(node, spawn_time, handshake)
         self.child.logfile_read = None
-        self.child.interact()
-        curses.cbreak()  # cbreak模式：除delete,ctrl等控制键外，其他的输入字符被立即读取
+        session = Session(node, self.child, recorder)
+        if self.screen is None:  # 命令行直接登录，没有启动界面，也就没有后台会话
+            self.child.interact(output_filter=session.record)
+            if not self.child.isalive():  # 会话已经结束，立即释放终端，不用等pexpect在析构时sleep
+                self._close_child(self.child)
+            if recorder is not None:
+                recorder.close()
+            return
+        self.resume_session(session)
+
+    # 登录失败时只关闭这一个连接。命令行直接登录时退出，在界面里时回到主机列表(后台会话不受影响)，
+    # 原因和远端输出的最后一行显示在状态行
+    def _login_failed(self, node, handshake, recorder, message):
+        self.child.logfile_read = None
+        self._close_child(self.child, True)
+        if recorder is not None:
+            recorder.close()
+        if self.screen is None:
+            print('\n\033[1;31;40m%s\033[0m' % message)
+            sys.exit(1)
+        last_line = handshake.buffer.strip().split('\n')[-1].strip()
+        self.status_message = '%s: %s%s' % (node.title, message, ' (%s)' % last_line if len(last_line) else '')
+        self.back_to_tree()
+
+    # 还没有启动ssh就出错了: 命令行直接登录时交给main打印错误并退出，在界面里时回到主机列表
+    def _login_error(self, e):
+        if self.screen is None:
+            raise e
+        self.status_message = str(e)
+        self.back_to_tree()
+
+    def back_to_tree(self):
+        curses.noecho()
+        curses.cbreak()
+        self.invalidate_screen()  # 终端已被ssh使用过，需要完整重绘
+
+    # 把终端交给会话，按 Ctrl-] 时会话转到后台并回到主机列表，会话结束时关闭
+    def resume_session(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        self.restore_screen()
+        self.child = session.child
+        self.sigwinch_passthrough()
+        signal.signal(signal.SIGWINCH, self.sigwinch_passthrough_with_param)
+        if len(session.buffer):
+            sys.stdout.flush()
+            os.write(sys.stdout.fileno(), b'\033[H\033[2J' + bytes(session.buffer))
+        self._interact(session)
+        if self._detached(session):
+            self.sessions.insert(0, session)
+            if session.recorder is not None:
+                session.recorder.flush()
+        else:
+            self._end_session(session)
+        self.back_to_tree()
         if self.search_keyword is not None:
             self.search_keyword = None  # 退出远程连接返回到本程序后退出搜索模式
 
-    def _get_visible_lines_for_render(self):
-        lines = []
-        stack = self.config + []
+    # 代替 pexpect 的 interact: 在键盘和前台会话之间转发数据，同时把后台会话的输出读进它们各自的缓冲区，
+    # 否则后台会话的pty写满后远端程序会卡住。按 Ctrl-] 或者前台会话结束时返回
+    def _interact(self, session):
+        import select
+        import tty
+        stdin, stdout = sys.stdin.fileno(), sys.stdout.fileno()
+        child_fd = session.child.child_fd
+        mode = termios.tcgetattr(stdin)
+        tty.setraw(stdin)
+        try:
+            while True:
+                fds = dict((background.child.child_fd, background) for background in self.sessions)
+                ready = select.select([stdin, child_fd] + list(fds), [], [])[0]
+                if child_fd in ready:
+                    try:
+                        data = os.read(child_fd, 65536)
+                    except OSError:  # 远端已经退出(EIO)
+                        data = b''
+                    if not len(data):
+                        return
+                    self._write_all(stdout, session.record(data))
+                for fd in ready:
+                    if fd in fds and not fds[fd].drain():
+                        self._close_session(fds[fd])
+                if stdin in ready:
+                    data = os.read(stdin, 1024)
+                    escape = data.find(bytes([self.KEY_SESSION]))
+                    self._write_all(child_fd, data if escape < 0 else data[:escape])
+                    if escape >= 0:
+                        return
+        finally:
+            termios.tcsetattr(stdin, termios.TCSAFLUSH, mode)
+
+    @staticmethod
+    def _write_all(fd, data):
+        while len(data):
+            data = data[os.write(fd, data):]
+
+    # 0: 刚刚离开的会话，1: 再之前的一个(没有时还是刚离开的那个)
+    def switch_session(self, index):
+        if len(self.sessions):
+            self.resume_session(self.sessions[min(index, len(self.sessions) - 1)])
+
+    # _interact 返回时区分是按了 Ctrl-] 还是会话结束了: 进程刚退出时 isalive 可能还是True，但pty已经读到EOF
+    @staticmethod
+    def _detached(session):
+        import select
+        if not session.child.isalive():
+            return False
+        return not len(select.select([session.child.child_fd], [], [], 0)[0]) or session.drain()
+
+    def _find_session(self, node):
+        for session in self.sessions:
+            if session.node.title == node.title:
+                return session
+        return None
+
+    def _close_session(self, session):
+        self.sessions.remove(session)
+        self._end_session(session)
+        self.status_message = 'session %s closed' % session.node.title
+
+    def close_sessions(self):
+        for session in self.sessions:
+            self._end_session(session, True)
+        self.sessions = []
+
+    def _end_session(self, session, force=False):
+        self._close_child(session.child, force)
+        if session.recorder is not None:
+            session.recorder.close()
+
+    @staticmethod
+    def _close_child(child, force=False):
+        child.delayafterclose = child.ptyproc.delayafterclose = 0
+        try:
+            child.close(force)
+        except Exception:  # pexpect 在进程没有及时退出时抛出 ExceptionPexpect
+            pass
+
+    # 有后台会话时用select同时等待键盘和各会话的输出，后台会话的输出读进各自的缓冲区。timeout单位毫秒，-1表示一直等
+    def _getch(self, timeout):
+        if not len(self.sessions):
+            self.screen.timeout(timeout)
+            return self.screen.getch()
+        import select
+        self.screen.timeout(0)
+        deadline = None if timeout < 0 else time.time() + timeout / 1000.0
+        while True:
+            c = self.screen.getch()
+            if c != -1:
+                return c
+            fds = dict((session.child.child_fd, session) for session in self.sessions)
+            wait = None if deadline is None else max(deadline - time.time(), 0)
+            ready = select.select([sys.stdin.fileno()] + list(fds), [], [], wait)[0]
+            closed = False
+            for fd in ready:
+                if fd in fds and not fds[fd].drain():
+                    self._close_session(fds[fd])
+                    closed = True
+            if closed or not len(ready):
+                return -1  # 超时，或者有会话结束了需要重绘
+
+    # 在nodes下的所有主机上并发执行同一条命令，输出按行加主机名前缀，最后打印每台主机的退出码和耗时。
+    # 所有连接在一个线程里用 selectors 驱动，最多同时 batch_parallel 个，返回失败的主机数
+    def run_batch(self, nodes, command, out=sys.stdout):
+        import selectors
+        import_pexpect()
+        leaves = []
+        seen = set()
+        for node in nodes:
+            for leaf in self._leaves_under(node):
+                if leaf.title not in seen:
+                    seen.add(leaf.title)
+                    leaves.append(leaf)
+        if not len(leaves):
+            return 0
+        width = max(len(leaf.title) for leaf in leaves)
+        pending = list(reversed(leaves))
+        running = {}  # fd -> BatchJob
+        jobs = []
+        selector = selectors.DefaultSelector()
+        closing = []  # (child, kill时间) 已经结束、等待回收的连接，不在主循环里阻塞等待
+        batch_start = time.time()
+
+        def emit(job, lines):
+            for line in lines:
+                out.write('%-*s | %s\n' % (width, job.node.title, line))
+            out.flush()
+
+        def finish(job, status):
+            job.finished = time.time()
+            job.status = status
+            if job.child is not None:
+                selector.unregister(job.child.child_fd)
+                del running[job.child.child_fd]
+                if status in ('error', 'timeout') and len(job.handshake.buffer.strip()):
+                    emit(job, job.handshake.buffer.strip().split('\n')[-1:])  # 最后一行一般是出错原因
+                # 正常结束的连接已经发送了exit，给ssh一点时间自己退出，其他的直接kill
+                closing.append((job.child, job.finished + (1 if status in ('ok', 'fail') else 0)))
+                if status != 'cancelled':
+                    self.record_login(job.node, 'exec', 0, job.handshake, job.connected is not None,
+                                      None if job.connected is not None else status, job.connected)
+
+        def reap():
+            now = time.time()
+            for entry in list(closing):
+                child, kill_time = entry
+                if not child.isalive():
+                    child.close()
+                    closing.remove(entry)
+                elif now > kill_time:
+                    child.kill(signal.SIGKILL)
+
+        try:
+            while len(pending) or len(running):
+                while len(pending) and len(running) < self.batch_parallel:
+                    node = pending.pop()
+                    try:
+                        begin_node, expect_list = self.login_steps(node)
+                        owners = self._expect_owners(node)
+                        expect_list = self.resolve_secrets(expect_list, owners)
+                    except ConfigError as e:
+                        job = BatchJob(node, None, Handshake((), command, node.title), time.time())
+                        jobs.append(job)
+                        emit(job, [str(e)])
+                        finish(job, 'error')
+                        continue
+                    child = pexpect.spawn(self.ssh_command_line(begin_node), encoding='utf-8', dimensions=(24, 512))
+                    # pexpect 默认发送前和关闭后都会sleep，在单线程里驱动很多连接时会累积起来
+                    child.delaybeforesend = None
+                    child.delayafterclose = child.ptyproc.delayafterclose = 0
+                    job = BatchJob(node, child, Handshake(expect_list, command, node.title, self.login_step_timeout,
+                                                          self.batch_timeout, owners), time.time())
+                    jobs.append(job)
+                    running[child.child_fd] = job
+                    selector.register(child.child_fd, selectors.EVENT_READ)
+                if not len(running):
+                    continue
+                now = time.time()
+                deadline = min(job.start for job in running.values()) + self.batch_timeout
+                for key, events in selector.select(max(min(deadline - now, 0.5), 0)):
+                    job = running[key.fd]
+                    try:
+                        data = job.child.read_nonblocking(65536, timeout=0)
+                    except pexpect.TIMEOUT:
+                        continue
+                    except pexpect.EOF:  # 连接在命令执行完之前断开，比如认证失败
+                        finish(job, 'error')
+                        continue
+                    replies, lines = job.handshake.feed(data)
+                    if job.connected is None and job.handshake.state not in ('login', 'prompt'):
+                        job.connected = time.time()
+                    emit(job, lines)
+                    for reply in replies:
+                        job.child.sendline(reply)
+                    if job.handshake.state == 'done':
+                        finish(job, 'ok' if job.handshake.exit_code == 0 else 'fail')
+                now = time.time()
+                for job in list(running.values()):
+                    try:
+                        job.handshake.check_deadline(now)
+                    except LoginTimeout as e:
+                        emit(job, [str(e)])
+                        finish(job, 'timeout')
+                reap()
+        except KeyboardInterrupt:
+            for job in list(running.values()):
+                finish(job, 'cancelled')
+        finally:
+            selector.close()
+            while len(closing):
+                reap()
+                time.sleep(0.01)
+
+        out.write('\n%-*s  %-9s %4s %9s %9s\n' % (width, 'host', 'status', 'rc', 'connect', 'total'))
+        for job in jobs:
+            rc = job.handshake.exit_code
+            line = '%-*s  %-9s %4s %9s %9s' % (
+                width, job.node.title, job.status, '-' if rc is None else rc,
+                '-' if job.connected is None else '%.0fms' % ((job.connected - job.start) * 1000),
+                '%.0fms' % ((job.finished - job.start) * 1000))
+            if job.status != 'ok' and out.isatty():
+                line = '\033[1;31m%s\033[0m' % line
+            out.write(line + '\n')
+        failed = sum(1 for job in jobs if job.status != 'ok')
+        out.write('%d hosts, %d ok, %d failed, %.1fs\n' % (len(jobs), len(jobs) - failed, failed,
+                                                          time.time() - batch_start))
+        out.flush()
+        return failed + len(leaves) - len(jobs)
+
+    def probe_target(self, node):
+        if node.ssh is None:
+            return None  # 通过pre_host跳转的主机无法直接探测
+        if node.ssh not in self._probe_targets:
+            self._probe_targets[node.ssh] = ssh_target(node.ssh)
+        return self._probe_targets[node.ssh]
+
+    def _probe_targets_under(self, nodes):
+        targets = []
+        stack = list(nodes)
         while len(stack):
             node = stack.pop()
-            lines.append(node)
-            if 'expanded' in node and node['expanded'] and len(node['sub_node']):
-                stack = stack + node['sub_node']
-
-        lines.sort(key=lambda n: n['line_number'], reverse=False)
+            if node.is_group:
+                stack.extend(node.sub_node)  # 还没加载的组不探测，加载时再探测
+            else:
+                target = self.probe_target(node)
+                if target is not None:
+                    targets.append(target)
+        return targets
+
+    # 探测所有已加载的主机，force 时忽略缓存的有效期
+    def start_probe(self, force=False):
+        if self.prober is None:
+            self.prober = Prober(self.probe_ttl, self.probe_banner)
+        self.prober.probe(self._probe_targets_under(self.config), force)
+
+    # 按延迟排序的主机列表，探测结果或主机列表有变化时才重新排序
+    def _latency_lines(self):
+        version = None if self.prober is None else self.prober.version
+        cache = self._latency_cache
+        if cache is not None and cache[:3] == (self.latency_view, version, len(self.title_index)):
+            return cache[3]
+        hosts = []
+        stack = list(reversed(self.config))
+        while len(stack):
+            node = stack.pop()
+            if node.is_group:
+                stack.extend(reversed(node.sub_node))
+                continue
+            target = self.probe_target(node)
+            result = None if target is None or self.prober is None else self.prober.results.get('%s:%d' % target)
+            rtt = None if result is None else result[1]
+            if rtt is not None:
+                hosts.append((0, rtt, node.line_number, node))
+            elif self.latency_view == 'sort':
+                down = result is not None and result[2] != 'unresolved'
+                hosts.append((1 if down else 2, 0, node.line_number, node))  # 不可达的在前，未探测的最后
+        lines = [host[3] for host in sorted(hosts, key=lambda host: host[:3])]
+        self._latency_cache = (self.latency_view, version, len(self.title_index), lines)
         return lines
 
-    def _make_sure_enter_bash(self):
-        while True:  # 设置本地终端标题 和 设置PS1 前需要确保已经进入了bash
-            i = self.child.expect(
-                [pexpect.TIMEOUT, '[$#]', r'Are you sure you want to continue connecting \(yes/no\)\?'])
-            if i == 0:  # Timeout
-                print('\033[1;31;40mTimeout!\033[0m')
-                sys.exit(1)
-            elif i == 1:
-                break
-            elif i == 2:  # SSH does not have the public key or key error. Just accept it.
-                self.child.sendline('yes')
+    # x: 在当前组(或主机)下的所有主机上执行命令
+    def exec_on_current(self):
+        visible_hosts = self.get_lines()
+        if not len(visible_hosts):
+            return
+        node = visible_hosts[self.current_row()]
+        command = self._read_line('exec on %s: ' % node.title)
+        if command is None or not len(command.strip()):
+            return
+        self.restore_screen()
+        print('\033[1;32m%s\033[0m $ %s' % (node.title, command))
+        self.run_batch([node], command)
+        input('\npress Enter to return')
+        curses.noecho()
+        curses.cbreak()
+        self.invalidate_screen()
+
+    def _read_line(self, prompt):
+        text = ''
+        curses.curs_set(1)
+        try:
+            while True:
+                screen_cols = self._screen_size[1]
+                line = (prompt + text)[-(screen_cols - 1):]
+                self.screen.move(0, 0)
+                self.screen.clrtoeol()
+                self.screen.addstr(0, 0, line)
+                self._rendered_rows[0] = ()  # 第0行被输入框覆盖
+                self.screen.refresh()
+                c = self.screen.get_wch()
+                if c in ('\n', '\r') or c == curses.KEY_ENTER:
+                    return text
+                elif c == chr(self.KEY_ESC):
+                    return None
+                elif c in ('\x7f', '\b') or c == curses.KEY_BACKSPACE:
+                    text = text[:-1]
+                elif isinstance(c, str) and c.isprintable():
+                    text += c
+        finally:
+            curses.curs_set(0)
+
+    def record_login(self, node, mode, spawn_time, handshake, ok, error=None, finished=None):
+        finished = time.time() if finished is None else finished
+        record = {'time': handshake.started, 'host': node.title, 'mode': mode, 'ok': ok,
+                  'spawn': round(spawn_time, 4), 'total': round(finished - handshake.started + spawn_time, 4),
+                  'steps': [[hop, key, round(seconds, 4), skipped] for hop, key, seconds, skipped in handshake.timings]}
+        if error is not None:
+            record['error'] = error
+        append_login_record(record)
+        if ok and self.last_connect is not None:
+            self.last_connect[node.title] = record['total']
+
+    def load_last_connect(self):
+        self.last_connect = {}
+        for record in read_login_records():
+            if record.get('ok'):
+                self.last_connect[record.get('host')] = record.get('total', 0)
+
+    # pre_host 跳转链上每一步expect属于哪台主机，用于 --trace-login 和登录耗时统计
+    def _expect_owners(self, node):
+        owners = {}
+        while node is not None:
+            for expect in node.expect:
+                owners[id(expect)] = node.title
+            node = None if node.pre_host is None else self.title_index.get(node.pre_host)
+        return owners
+
+    def _print_login_trace(self, node, spawn_time, handshake):
+        total = time.time() - handshake.started + spawn_time
+        rows = [('spawn ssh', spawn_time, False)] + [('%s: %s' % (hop, key) if len(hop) else key, seconds, skipped)
+                                                     for hop, key, seconds, skipped in handshake.timings]
+        width = max(len(label) for label, seconds, skipped in rows)
+        sys.stdout.write('\r\n\033[2m--- login trace: %s, %d steps, %.0fms\r\n' % (node.title, len(handshake.timings),
+                                                                              total * 1000))
+        for label, seconds, skipped in rows:
+            sys.stdout.write('%-*s %8.0fms%s\r\n' % (width, label, seconds * 1000, ' (skipped)' if skipped else ''))
+        sys.stdout.write('\033[0m')
+        sys.stdout.flush()
+
+    # 可见行索引: self.visible 是所有可见节点的先序列表，展开/折叠时只拼接受影响的子树
+    def _visible_descendants(self, nodes):
+        rt = []
+        stack = list(reversed(nodes))
+        while len(stack):
+            anode = stack.pop()
+            rt.append(anode)
+            if anode.expanded and anode.is_group:
+                self.load_group(anode)
+                stack.extend(reversed(anode.sub_node))
+        return rt
+
+    def _rebuild_visible(self):
+        self.visible = self._visible_descendants(([] if self.recent_group is None else [self.recent_group]) + self.config)
+
+    # 按frecency重新生成"recent"组，替换可见列表最前面的旧组
+    def _refresh_recent(self):
+        old_group = self.recent_group
+        del self.visible[:self._recent_rows()]
+        self.recent_group = None
+        hosts = [self.title_index[title] for title in self.usage.ranked()
+                 if title in self.title_index and not self.title_index[title].is_group][:self.recent_size]
+        if not len(hosts):
+            return
+        group = GroupNode('recent', None, None, Node.NO_EXPECT, True if old_group is None else old_group.expanded,
+                          None, 0, 0)
+        group.sub_node = [HostNode(node.title, node.ssh, node.pre_host, node.expect, False, group, 1, node.line_number)
+                          for node in hosts]
+        self.recent_group = group
+        self.visible[0:0] = self._visible_descendants([group])
+
+    def _recent_rows(self):
+        if self.recent_group is None or not len(self.visible) or self.visible[0] is not self.recent_group:
+            return 0
+        return self._subtree_end(0)
+
+    # 数字键 1-9,0 直接登录 recent 组里对应的主机
+    def connect_recent(self, index):
+        if self.recent_group is None or index >= len(self.recent_group.sub_node):
+            return
+        self.restore_screen()
+        self.do_ssh(self.recent_group.sub_node[index])
+
+    def _subtree_end(self, row):
+        # 返回 row 对应节点在可见列表中最后一个后代的下一行
+        level = self.visible[row].level
+        end = row + 1
+        while end < len(self.visible) and self.visible[end].level > level:
+            end += 1
+        return end
+
+    def _expand_row(self, row):
+        node = self.visible[row]
+        node.expanded = True
+        self.load_group(node)
+        self.visible[row + 1:self._subtree_end(row)] = self._visible_descendants(node.sub_node)
+
+    def _collapse_row(self, row):
+        self.visible[row].expanded = False
+        del self.visible[row + 1:self._subtree_end(row)]
 
     def exit(self):
         if self.search_keyword is not None:
@@ -316,31 +2593,249 @@ class SSHGO:
         else:
             sys.exit(0)
 
+    # 界面状态快照: 组的title是唯一的，按先序(上级在前)记录所有已加载的组的title和是否展开，
+    # 包括被折叠的上级下面看不见的组，不然配置里默认展开的组被折叠后下次又会展开。
+    # 恢复时按title_index查找，配置改过之后也能对上；只遍历组，不遍历主机
+    def state_file(self):
+        return cache_file_for(self.config_file, 'state')
+
+    def save_state(self):
+        recent_rows = self._recent_rows()
+        groups = []
+        stack = [node for node in reversed(self.config) if node.is_group]
+        while len(stack):
+            node = stack.pop()
+            groups.append((node.title, node.expanded))
+            stack.extend(child for child in reversed(node.sub_node) if child.is_group)
+        state = {'version': 2,
+                 'groups': groups,
+                 'recent': None if self.recent_group is None else self.recent_group.expanded,
+                 'search': self.last_search}
+        row = self.current_row()
+        if self.tree_view() and row < len(self.visible):
+            state['cursor'] = row if row < recent_rows else self.visible[row].title  # recent组里的行按行号记录
+            state['screen_row'] = self.highlight_line_number
+        try:
+            with open(self.state_file() + '.tmp', 'w') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(self.state_file() + '.tmp', self.state_file())
+        except OSError:
+            pass
+
+    def restore_state(self):
+        try:
+            with open(self.state_file(), 'r') as f:
+                state = json.load(f)
+            if state.get('version') != 2:
+                return
+            groups = [(title, bool(expanded)) for title, expanded in state['groups']]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return
+        for title, expanded in groups:
+            node = self.title_index.get(title)
+            if node is None or not node.is_group:
+                continue
+            node.expanded = expanded
+            if expanded:
+                try:
+                    self.load_group(node)  # include的组里的子组排在它后面，加载后才能在title_index里找到
+                except ConfigError as e:
+                    node.expanded = False
+                    self.status_message = str(e)
+        if self.recent_group is not None and state.get('recent') is not None:
+            self.recent_group.expanded = bool(state['recent'])
+        self._rebuild_visible()
+        search = state.get('search')
+        if isinstance(search, list) and len(search) == 2 and search[0] in self.SEARCH_MODES:
+            self.last_search = tuple(search)
+        cursor = state.get('cursor')
+        if isinstance(cursor, int):
+            row = cursor if cursor < self._recent_rows() else 0
+        elif isinstance(cursor, str) and cursor in self.title_index:
+            row = self._visible_row(self.title_index[cursor])
+        else:
+            return
+        screen_row = state.get('screen_row')
+        self.top_line_number = max(row - (screen_row if isinstance(screen_row, int) else 0), 0)
+        self.move_to(row)
+
+    # 节点所在的行，节点被折叠起来时取最近的可见上级
+    def _visible_row(self, node):
+        path = []
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        node = path.pop()
+        while len(path) and node.expanded:
+            node = path.pop()
+        return self.visible.index(node, self._recent_rows())
+
     def enter_search_mode(self):
-        screen_cols = curses.tigetnum('cols')
-        self.screen.addstr(0, 0, '/' + ' ' * screen_cols)
-        curses.echo()
+        # 边输入边过滤: 每输入一个字符就在上一次的结果上缩小范围。输入框为空时按上方向键调出上一次的搜索
+        keyword = ''
         curses.curs_set(1)
-        self.search_keyword = self.screen.getstr(0, 1)  # 获取输入的要搜索的内容
-        curses.noecho()
+        while True:
+            self.search_keyword = keyword
+            self.page_top()
+            self.render_screen()
+            self._draw_search_prompt(keyword)
+            c = self.screen.get_wch()
+            if c in ('\n', '\r') or c == curses.KEY_ENTER:
+                if len(keyword):
+                    self.last_search = (self.search_mode, keyword)
+                break
+            elif c == curses.KEY_UP and not len(keyword) and self.last_search is not None:
+                self.search_mode, keyword = self.last_search
+            elif c == chr(self.KEY_ESC):
+                self.search_keyword = None
+                break
+            elif c in ('\x7f', '\b') or c == curses.KEY_BACKSPACE:
+                keyword = keyword[:-1]
+            elif c == '\t':
+                self.search_mode = self.SEARCH_MODES[(self.SEARCH_MODES.index(self.search_mode) + 1)
+                                                     % len(self.SEARCH_MODES)]
+            elif isinstance(c, str) and c.isprintable():
+                keyword += c
         curses.curs_set(0)
 
-    def _search_node(self):
-        rt = []
-        stack = self.config + []
+    def _draw_search_prompt(self, keyword):
+        screen_cols = self._screen_size[1]
+        mode = '[%s]' % self.search_mode
+        prompt = ('/' + keyword)[:max(screen_cols - len(mode) - 2, 1)]
+        self.screen.move(0, 0)
+        self.screen.clrtoeol()
+        self.screen.addstr(0, 0, prompt)
+        self.screen.addstr(0, screen_cols - len(mode) - 1, mode, curses.color_pair(self.COLOR_RED))
+        self._rendered_rows[0] = ()  # 第0行被搜索输入框覆盖
+        self._put_scroll_cell(0, self._marker_row == 0)
+        self.screen.move(0, len(prompt))
+        self.screen.refresh()
+
+    # 搜索索引: 叶子节点按行号排列，title 前缀索引用于 regex 模式下的纯文本查询，
+    # title+ssh+组路径 的三元组倒排索引用于 substring 模式。三元组索引在后台线程里建立(15000台主机约300ms)，
+    # 建好之前 substring 模式逐个比较，也不到一帧
+    def _build_search_index(self):
+        self.load_all_groups()
+        leaves = []
+        texts = []
+        stack = [(node, '') for node in reversed(self.config)]
         while len(stack):
-            node = stack.pop()
-            if (not len(node['sub_node'])) and re.match(self.search_keyword.decode(), (node['title'])) is not None:
-                rt.append(node)
-            if len(node['sub_node']):
-                stack = stack + node['sub_node']
+            node, path = stack.pop()
+            if node.is_group:
+                path = path + node.title + '/'
+                stack.extend((anode, path) for anode in reversed(node.sub_node))
+                continue
+            text = ' '.join((node.title, node.ssh or '', path)).lower()
+            leaves.append(node)
+            texts.append(text)
+        self._search_leaves = leaves
+        self._search_texts = texts
+        self._search_trigrams = None
+        self._search_titles = sorted((node.title, leaf_id) for leaf_id, node in enumerate(leaves))
+        self._search_cache = None
+        self._trigram_thread = threading.Thread(target=self._build_trigram_index, args=(texts,), daemon=True)
+        self._trigram_thread.start()
+
+    def _build_trigram_index(self, texts=None):
+        texts = self._search_texts if texts is None else texts
+        trigrams = {}
+        for leaf_id, text in enumerate(texts):
+            for gram in set(text[i:i + 3] for i in range(len(text) - 2)):
+                trigrams.setdefault(gram, []).append(leaf_id)
+        if texts is self._search_texts:  # 建立期间重新加载了配置时丢掉
+            self._search_trigrams = trigrams
+
+    def _trigram_candidates(self, keyword):
+        grams = set(keyword[i:i + 3] for i in range(len(keyword) - 2))
+        if not len(grams) or self._search_trigrams is None:
+            return range(len(self._search_leaves))
+        postings = sorted((self._search_trigrams.get(gram, ()) for gram in grams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if len(candidates) < 64:
+                break  # 候选已经很少了，剩下的直接逐个校验
+            candidates.intersection_update(posting)
+        return sorted(candidates)
+
+    @staticmethod
+    def _is_refinement(keyword, last_keyword):
+        # substring/fuzzy 模式下，在上次关键字后面追加字符得到的结果一定是上次结果的子集
+        return last_keyword is not None and keyword.startswith(last_keyword)
+
+    def _search_node(self):
+        if self._search_leaves is None:
+            self._build_search_index()
+        keyword = self.search_keyword
+        mode = self.search_mode
+        if self._search_cache is not None and self._search_cache[:2] == (mode, keyword):
+            return self._search_cache[2]
+
+        if mode == 'regex':
+            if self.REGEX_SPECIAL.isdisjoint(keyword):
+                start = bisect.bisect_left(self._search_titles, (keyword,))
+                end = start
+                while end < len(self._search_titles) and self._search_titles[end][0].startswith(keyword):
+                    end += 1
+                ids = sorted(leaf_id for title, leaf_id in self._search_titles[start:end])
+            else:
+                try:
+                    pattern = re.compile(keyword)
+                except re.error:  # 输入到一半的正则，先按纯文本处理
+                    pattern = re.compile(re.escape(keyword))
+                ids = [i for i in range(len(self._search_leaves))
+                       if pattern.match(self._search_leaves[i].title) is not None]
+        else:
+            lowered = keyword.lower()
+            if self._search_cache is not None and self._search_cache[0] == mode and self._is_refinement(
+                    keyword, self._search_cache[1]):
+                ids = self._search_cache[3]
+            elif mode == 'substring':
+                ids = self._trigram_candidates(lowered)
+            else:
+                ids = range(len(self._search_leaves))
+            if mode == 'substring':
+                ids = [i for i in ids if lowered in self._search_texts[i]]
+            else:
+                pattern = re.compile('.*?'.join(re.escape(ch) for ch in lowered))
+                ids = [i for i in ids if pattern.search(self._search_texts[i]) is not None]
+
+        rt = [self._search_leaves[i] for i in ids]
+        if self.usage is not None and len(self.usage.entries):  # 常用的主机排在前面，其余保持原来的顺序
+            scores = self.usage.scores()
+            rt.sort(key=lambda node: -scores.get(node.title, 0))
+        self._search_cache = (mode, keyword, rt, ids)
         return rt
 
     def get_lines(self):
         if self.search_keyword is not None:
             return self._search_node()
+        elif self.latency_view is not None:
+            return self._latency_lines()
         else:
-            return self._get_visible_lines_for_render()
+            return self.visible
+
+    def current_row(self):
+        return self.top_line_number + self.highlight_line_number
+
+    # 直接计算目标行对应的 top_line_number/highlight_line_number，滚动距离最小
+    def move_to(self, row):
+        lines_count = len(self.get_lines())
+        if not lines_count:
+            self.top_line_number = 0
+            self.highlight_line_number = 0
+            return
+        screen_lines = curses.tigetnum('lines')
+        row = max(0, min(row, lines_count - 1))
+        top = min(self.top_line_number, max(lines_count - screen_lines, 0))
+        if row < top:
+            top = row
+        elif row >= top + screen_lines:
+            top = row - screen_lines + 1
+        self.top_line_number = top
+        self.highlight_line_number = row - top
+
+    def page(self, direction):
+        self.move_to(self.current_row() + direction * curses.tigetnum('lines'))
 
     def page_top(self):
         self.top_line_number = 0
@@ -352,47 +2847,75 @@ class SSHGO:
         self.top_line_number = max(len(visible_hosts) - screen_lines, 0)
         self.highlight_line_number = min(screen_lines, len(visible_hosts)) - 1
 
+    def _parent_row(self, row):
+        # 父节点一定是上方第一个 level 更小的行
+        level = self.visible[row].level
+        while row > 0:
+            row -= 1
+            if self.visible[row].level < level:
+                return row
+        return None
+
+    def _last_child_row(self, row):
+        level = self.visible[row].level + 1
+        end = self._subtree_end(row) - 1
+        while end > row and self.visible[end].level != level:
+            end -= 1
+        return end
+
+    # 搜索结果和按延迟排序的列表都是扁平的，不能按树形展开折叠
+    def tree_view(self):
+        return self.search_keyword is None and self.latency_view is None
+
     def open_node(self):
         visible_hosts = self.get_lines()
         line_num = self.top_line_number + self.highlight_line_number
+        if not len(visible_hosts):
+            return
         node = visible_hosts[line_num]
-        if not len(node['sub_node']):
+        if not node.is_group:
             return
         stack = [node]
         while len(stack):
-            node = stack.pop()
-            node['expanded'] = True  # 这是关键
-            if len(node['sub_node']):
-                stack = stack + node['sub_node']
+            anode = stack.pop()
+            anode.expanded = True  # 这是关键
+            self.load_group(anode)
+            stack.extend(anode.sub_node)
+        if self.tree_view():
+            self._expand_row(line_num)
 
     def close_node(self):
         visible_hosts = self.get_lines()
         line_num = self.top_line_number + self.highlight_line_number
+        if not len(visible_hosts):
+            return
         node = visible_hosts[line_num]
-        if not len(node['sub_node']):  # 如果当前不在node上，那么移动到node上后折叠node。
-            parent_node = node['parent']
-            increment = node['line_number'] - parent_node['line_number']
-            for i in range(0, increment):
-                self.updown(-1)
+        if not node.is_group:  # 如果当前不在node上，那么移动到node上后折叠node。
+            if not self.tree_view() or node.parent is None:
+                return
+            self.move_to(self._parent_row(line_num))
             self.close_node()
             return
         stack = [node]
         while len(stack):
-            node = stack.pop()
-            node['expanded'] = False
-            if len(node['sub_node']):
-                stack = stack + node['sub_node']
+            anode = stack.pop()
+            anode.expanded = False
+            stack.extend(anode.sub_node)
+        if self.tree_view():
+            self._collapse_row(line_num)
 
     def pre_node(self):  # 关闭当前组，切换到上一组的最后一个
         self.close_node()
         self.updown(-1)
         visible_hosts = self.get_lines()
         line_num = self.top_line_number + self.highlight_line_number
+        if not len(visible_hosts):
+            return
         node = visible_hosts[line_num]
-        if len(node['sub_node']):
+        if node.is_group:
             self.open_node()
-            for i in range(0, len(node['sub_node'])):
-                self.updown(1)
+            if self.tree_view():
+                self.move_to(self._last_child_row(line_num))
 
     def next_node(self):  # 关闭当前组，切换到下一组的第一个
         self.close_node()
@@ -404,38 +2927,145 @@ class SSHGO:
         stack = self.config + []
         while len(stack):
             node = stack.pop()
-            if len(node['sub_node']):
-                node['expanded'] = True
-                stack = stack + node['sub_node']
+            if node.is_group:
+                node.expanded = True
+                self.load_group(node)
+                stack.extend(node.sub_node)
+        self._rebuild_visible()
 
     def close_all(self):
         stack = self.config + []
         while len(stack):
             node = stack.pop()
-            if len(node['sub_node']):
-                node['expanded'] = False
-                stack = stack + node['sub_node']
+            if node.is_group:
+                node.expanded = False
+                stack.extend(node.sub_node)
+        self._rebuild_visible()
 
     def toggle_node(self):
         visible_hosts = self.get_lines()
         line_num = self.top_line_number + self.highlight_line_number
-        if not len(visible_hosts) and self.search_keyword is not None:
+        if not len(visible_hosts):
             self.search_keyword = None  # 退出搜索模式
             return
         node = visible_hosts[line_num]
-        if len(node['sub_node']):
-            node['expanded'] = not node['expanded']
+        if node.is_group:
+            if not self.tree_view():
+                node.expanded = not node.expanded
+            elif node.expanded:
+                self._collapse_row(line_num)
+            else:
+                self._expand_row(line_num)
         else:
             self.restore_screen()
             self.do_ssh(node)
 
-    def render_screen(self):
-        # clear screen
+    def invalidate_screen(self):
+        self._screen_size = None
+
+    def _scroll_char(self, row):
+        if row == 0:
+            return '^'
+        if row == self._screen_size[0] - 1:
+            return 'v'
+        return '|'
+
+    def _put_scroll_cell(self, row, marker):
+        screen_cols = self._screen_size[1]
+        if marker:
+            self.screen.insstr(row, screen_cols - 1, '+', curses.color_pair(self.COLOR_RED))
+        else:
+            self.screen.insstr(row, screen_cols - 1, self._scroll_char(row))
+        self.frame_cells += 1
+        self.frame_bytes += 1
+
+    def _full_redraw(self, screen_lines, screen_cols):
         self.screen.clear()
+        self._screen_size = (screen_lines, screen_cols)
+        self._rendered_rows = [None] * screen_lines
+        self._marker_row = None
+        # 滚动条等窗口只在首次绘制或终端大小变化时创建, why see https://stackoverflow.com/a/53757902
+        self.scroll_bar = self.screen.subwin(screen_lines - 2, 1, 1, screen_cols - 1)
+        self.scroll_bar.border(*(['|'] * 8))
+        self.top_right = self.screen.subwin(1, 1, 0, screen_cols - 1)
+        self.top_right.border(*(['^'] * 8))
+        self.bottom_right = self.screen.subwin(1, 1, screen_lines - 1, screen_cols - 1)
+        self.bottom_right.border(*(['v'] * 8))
+        for win in (self.scroll_bar, self.top_right, self.bottom_right):
+            win.noutrefresh()
+        self.frame_cells += screen_lines
+        self.frame_bytes += screen_lines
+
+    def _render_row(self, index, state):
+        screen_cols = self._screen_size[1]
+        self.screen.move(index, 0)
+        self.screen.clrtoeol()
+        if state is not None:
+            prefix, line, highlight, health = state
+            if health is not None:  # 右侧显示探测到的延迟或down
+                column = screen_cols - 2 - len(health[0])
+                line = line[:max(column - 1 - len(prefix), 0)]
+                self.screen.addstr(index, column, health[0], 0 if health[1] else curses.color_pair(self.COLOR_RED))
+                self.frame_cells += len(health[0])
+                self.frame_bytes += len(health[0])
+            line = line[:max(screen_cols - 1 - len(prefix), 0)]
+            if not highlight:
+                self.screen.addstr(index, 0, prefix, curses.color_pair(self.COLOR_RED))
+                self.screen.addstr(index, len(prefix), line)
+            else:
+                self.screen.addstr(index, 0, prefix, curses.color_pair(self.COLOR_RED_HIGH))
+                self.screen.addstr(index, len(prefix), line, curses.color_pair(self.COLOR_HIGHLIGHT))
+            self.frame_cells += len(prefix) + len(line)
+            self.frame_bytes += len(prefix) + len(line.encode('utf-8'))
+        self._rendered_rows[index] = state
+        # clrtoeol 会清掉最右侧的滚动条
+        self._put_scroll_cell(index, index == self._marker_row)
+
+    def _row_state(self, node, highlight):
+        line = node.title
+        if node.is_group:
+            line += '(%s)' % node.child_count()
+
+        prefix = ''
+        if self.tree_view():
+            prefix += '  ' * node.level
+        if node.is_group:
+            if node.expanded:
+                prefix += '-'
+            else:
+                prefix += '+'
+        elif self.recent_group is not None and node.parent is self.recent_group:
+            prefix += str((node.parent.sub_node.index(node) + 1) % 10)  # 按对应的数字键直接登录
+        elif self._find_session(node) is not None:
+            prefix += '>'  # 有在后台的会话，进入时直接切换过去
+        elif self.is_warm(node):
+            prefix += '*'  # 已经有可复用的ssh连接
+        else:
+            prefix += '|'
+        prefix += ' '
+        health = None  # 右侧显示的(最近一次登录耗时 探测到的延迟, 是否正常)
+        if not node.is_group:
+            parts = []
+            ok = True
+            if self.last_connect is not None and node.title in self.last_connect:
+                parts.append('%.1fs' % self.last_connect[node.title])
+            target = None if self.prober is None else self.probe_target(node)
+            if target is not None and self.prober.health(target) is not None:
+                text, ok = self.prober.health(target)
+                parts.append(text)
+            if len(parts):
+                health = (' '.join(parts), ok)
+        return prefix, line, highlight, health
+
+    # 只重绘内容或高亮状态发生变化的行
+    def render_screen(self):
+        self.frame_cells = 0
+        self.frame_bytes = 0
 
-        # now paint the rows
         screen_lines = curses.tigetnum('lines')
         screen_cols = curses.tigetnum('cols')
+        if self._screen_size != (screen_lines, screen_cols):
+            self._full_redraw(screen_lines, screen_cols)
 
         if self.highlight_line_number >= screen_lines:
             self.highlight_line_number = screen_lines - 1
@@ -448,88 +3078,41 @@ class SSHGO:
         bottom = self.top_line_number + screen_lines
         nodes = all_nodes[top:bottom]
 
-        if not len(nodes):
-            self.screen.refresh()
-            return
-
-        if self.highlight_line_number >= len(nodes):
+        if len(nodes) and self.highlight_line_number >= len(nodes):
             self.highlight_line_number = len(nodes) - 1
 
-        if self.top_line_number >= len(all_nodes):
-            self.top_line_number = 0
-
-        for (index, node,) in enumerate(nodes):
-            # line_num = self.top_line_number + index
-
-            line = node['title']
-            if len(node['sub_node']):
-                line += '(%d)' % len(node['sub_node'])
-
-            prefix = ''
-            if self.search_keyword is None:
-                prefix += '  ' * node['level']
-            if len(node['sub_node']):
-                if node['expanded']:
-                    prefix += '-'
-                else:
-                    prefix += '+'
+        marker_row = None
+        if len(nodes):
+            scroll_top = int(math.ceil((self.top_line_number + 1.0) / max(len(all_nodes), screen_lines) * screen_lines - 1))
+            scroll_height = int(math.ceil((len(nodes) + 0.0) / len(all_nodes) * screen_lines))
+            highlight_pos = int(
+                math.ceil(scroll_height * ((self.highlight_line_number + 1.0) / min(screen_lines, len(nodes)))))
+            marker_row = min(screen_lines, scroll_top + highlight_pos) - 1
+        if marker_row != self._marker_row:
+            old_marker_row = self._marker_row
+            self._marker_row = marker_row
+            if old_marker_row is not None:
+                self._put_scroll_cell(old_marker_row, False)
+            if marker_row is not None:
+                self._put_scroll_cell(marker_row, True)
+
+        for index in range(0, screen_lines):
+            if index < len(nodes):
+                state = self._row_state(nodes[index], index == self.highlight_line_number)
             else:
-                prefix += '|'
-            prefix += ' '
+                state = None
+            if state != self._rendered_rows[index]:
+                self._render_row(index, state)
 
-            # highlight current line
-            if index != self.highlight_line_number:
-                self.screen.addstr(index, 0, prefix, curses.color_pair(self.COLOR_RED))
-                self.screen.addstr(index, len(prefix), line)
-            else:
-                self.screen.addstr(index, 0, prefix, curses.color_pair(self.COLOR_RED_HIGH))
-                self.screen.addstr(index, len(prefix), line, curses.color_pair(self.COLOR_HIGHLIGHT))
-
-        # draw scroll bar
-        self.scroll_bar = self.screen.subwin(screen_lines - 2, 1, 1, screen_cols - 1)
-        self.scroll_bar.border(*(['|'] * 8))
-        self.scroll_bar.noutrefresh()
-        # self.screen.noutrefresh()
-        # draw right top point, why see https://stackoverflow.com/a/53757902
-        self.top_right = self.screen.subwin(1, 1, 0, screen_cols - 1)
-        self.top_right.border(*(['^'] * 8))
-        self.top_right.noutrefresh()
-        # draw right bottom point
-        self.bottom_right = self.screen.subwin(1, 1, screen_lines - 1, screen_cols - 1)
-        self.bottom_right.border(*(['v'] * 8))
-        self.bottom_right.noutrefresh()
-        # curses.doupdate()
-
-        scroll_top = int(math.ceil((self.top_line_number + 1.0) / max(len(all_nodes), screen_lines) * screen_lines - 1))
-        scroll_height = int(math.ceil((len(nodes) + 0.0) / len(all_nodes) * screen_lines))
-        highlight_pos = int(
-            math.ceil(scroll_height * ((self.highlight_line_number + 1.0) / min(screen_lines, len(nodes)))))
-        self.screen.insstr(min(screen_lines, scroll_top + highlight_pos) - 1, screen_cols - 1, '+',
-                           curses.color_pair(self.COLOR_RED))
-        self.screen.refresh()
+        self.screen.noutrefresh()
+        curses.doupdate()
+        self.render_stats['frames'] += 1
+        self.render_stats['cells'] += self.frame_cells
+        self.render_stats['bytes'] += self.frame_bytes
 
     # move highlight up/down one line
     def updown(self, increment):
-        visible_hosts = self.get_lines()
-        visible_lines_count = len(visible_hosts)
-        next_line_number = self.highlight_line_number + increment
-
-        # paging
-        if increment < 0 and self.highlight_line_number == 0 and self.top_line_number != 0:
-            self.top_line_number += self.UP
-            return
-        elif increment > 0 and next_line_number == curses.tigetnum('lines') and (
-                self.top_line_number + curses.tigetnum('lines')) != visible_lines_count:
-            self.top_line_number += self.DOWN
-            return
-
-        # scroll highlight line
-        if increment < 0 and (self.top_line_number != 0 or self.highlight_line_number != 0):
-            self.highlight_line_number = next_line_number
-        elif increment > 0 and (
-                self.top_line_number + self.highlight_line_number + 1) != visible_lines_count \
-                and self.highlight_line_number != curses.tigetnum('lines'):
-            self.highlight_line_number = next_line_number
+        self.move_to(self.current_row() + increment)
 
     # catch any weird termination situations
     def __del__(self):
@@ -538,7 +3121,10 @@ class SSHGO:
     # 用于pexpect设置屏幕大小，防止vim只显示半屏
     def sigwinch_passthrough(self):
         s = struct.pack("HHHH", 0, 0, 0, 0)
-        a = struct.unpack('hhhh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, s))
+        try:
+            a = struct.unpack('hhhh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, s))
+        except OSError:
+            return  # 输出被重定向，不是终端
         if not self.child.closed:
             self.child.setwinsize(a[0], a[1])
 
@@ -546,6 +3132,8 @@ class SSHGO:
         self.sigwinch_passthrough()
 
     def restore_screen(self):
+        if self.screen is None or curses.isendwin():
+            return  # curses还没初始化或者已经恢复过了
         curses.initscr()
         # nocbreak模式：字符先缓存，再输出
         curses.nocbreak()
@@ -553,10 +3141,151 @@ class SSHGO:
         curses.endwin()
 
 
-if __name__ == '__main__':
-    parser = OptionParser()
+def print_completion_script(parser, shell):
+    options, value_options = [], []  # -c/--config 在脚本里单独补全文件名
+    for option in parser.option_list:
+        names = str(option).split('/')
+        options.extend(names)
+        if option.takes_value() and option.dest != 'config':
+            value_options.extend(names)
+    script = BASH_COMPLETION if shell == 'bash' else ZSH_COMPLETION
+    print(script % {'options': ' '.join(options), 'value_options': '|'.join(value_options)}, end='')
+
+
+def secret_command(args, path, ttl):
+    import getpass
+    action = args[0] if len(args) else 'status'
+    store = SecretStore(path)
+    socket_path = agent_socket_for(path)
+    if action in ('set', 'rm') and len(args) != 2:
+        raise ConfigError('usage: %s secret %s NAME' % (sys.argv[0], action))
+    if action == 'init':
+        if os.path.exists(path):
+            raise ConfigError('secret store %s already exists' % path)
+        password = getpass.getpass('new master password: ')
+        if password != getpass.getpass('repeat master password: '):
+            raise ConfigError('passwords do not match')
+        store.init(password)
+        store.save()
+        print('created %s' % path)
+    elif action == 'set':
+        store.load().prompt_unlock()
+        # 不是终端时从标准输入读一行，方便在脚本里导入
+        value = getpass.getpass('%s: ' % args[1]) if sys.stdin.isatty() else sys.stdin.readline().rstrip('\n')
+        store.set(args[1], value)
+        store.save()
+    elif action == 'rm':
+        store.load().prompt_unlock()
+        store.remove(args[1])
+        store.save()
+    elif action == 'list':
+        for name in sorted(store.load().secrets):
+            print(name)
+    elif action == 'unlock':
+        try:
+            print('agent already running, locks in %ss' % agent_request(socket_path, 'status'))
+            return
+        except OSError:
+            pass
+        store.load().prompt_unlock()
+        SecretAgent(store, ttl).start(socket_path)
+        print('unlocked for %ds' % ttl)
+    elif action in ('lock', 'status'):
+        try:
+            left = agent_request(socket_path, action)
+        except OSError:
+            print('locked')
+            return
+        print('locked' if action == 'lock' else 'unlocked, locks in %ss' % left)
+    else:
+        raise ConfigError('unknown secret command %s, use init, set, rm, list, unlock, lock or status' % action)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [title or pattern]\n'
+                                '       %prog [options] -e COMMAND [host or group title ...]\n'
+                                '       %prog stats [host title ...]\n'
+                                '       %prog secret init|set NAME|rm NAME|list|unlock|lock|status')
     parser.add_option('-c', '--config', help='use specified config file instead of ~/.ssh_hosts')
+    parser.add_option('--search-mode', choices=SSHGO.SEARCH_MODES, default='regex',
+                      help='initial search mode: regex (match title), substring or fuzzy '
+                           '(title, ssh and group path); Tab switches mode while searching')
+    parser.add_option('--no-cache', action='store_true', default=False,
+                      help='do not read or write the compiled inventory cache')
+    parser.add_option('--ssh-command', help='ssh client to run instead of zssh/ssh')
+    parser.add_option('--no-multiplex', action='store_true', default=False,
+                      help='do not share connections through OpenSSH ControlMaster sockets')
+    parser.add_option('--control-persist', default='10m',
+                      help='how long an idle master connection stays open (ssh ControlPersist), default 10m')
+    parser.add_option('-e', '--exec', dest='command',
+                      help='run COMMAND on every host under the given titles (default: all hosts) and exit')
+    parser.add_option('-l', '--list', action='store_true', default=False,
+                      help='print the hosts matching the title or pattern (all hosts if none) and exit')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='like --list, but print title, ssh, pre_host and group of each host as JSON')
+    parser.add_option('--complete', metavar='PREFIX',
+                      help='print the hosts and groups whose title starts with PREFIX (title<TAB>group) and exit, '
+                           'used by shell completion')
+    parser.add_option('--complete-index', action='store_true', default=False,
+                      help='rebuild the completion index if the config changed and print its path')
+    parser.add_option('--complete-daemon', action='store_true', default=False,
+                      help='answer completion queries from memory on a Unix socket next to the index, '
+                           'exits after an hour idle')
+    parser.add_option('--completion-script', choices=('bash', 'zsh'),
+                      help='print the bash or zsh completion script, load it with eval "$(%prog --completion-script bash)"')
+    parser.add_option('--parallel', type='int', default=SSHGO.batch_parallel,
+                      help='hosts connected at the same time by --exec or the x key, default %default')
+    parser.add_option('--timeout', type='float', default=SSHGO.batch_timeout,
+                      help='per host timeout in seconds for --exec or the x key, default %default')
+    parser.add_option('--step-timeout', type='float', default=SSHGO.login_step_timeout,
+                      help='seconds to wait for each expected prompt while logging in, 0 for no limit, default %default')
+    parser.add_option('--login-timeout', type='float', default=SSHGO.login_timeout,
+                      help='seconds the whole login may take, 0 for no limit, default %default')
+    parser.add_option('--trace-login', action='store_true', default=False,
+                      help='print how long each login step (per hop) took before handing over the session')
+    parser.add_option('--recent', type='int', default=SSHGO.recent_size,
+                      help='number of frequently used hosts shown in the "recent" group (keys 1-9,0), 0 to disable, '
+                           'default %default')
+    parser.add_option('--show-connect-time', action='store_true', default=False,
+                      help='show how long the last login to each host took (see "%prog stats")')
+    parser.add_option('--probe', action='store_true', default=False,
+                      help='check in the background whether each host\'s ssh port is reachable and show the latency')
+    parser.add_option('--probe-banner', action='store_true', default=False,
+                      help='also read the SSH banner when probing')
+    parser.add_option('--probe-ttl', type='int', default=SSHGO.probe_ttl,
+                      help='seconds a cached probe result stays valid, default %default')
+    parser.add_option('--reload-interval', type='float', default=SSHGO.reload_interval,
+                      help='seconds between checks whether the config file changed, the tree is reloaded in place '
+                           'keeping expanded groups, cursor and search; 0 to disable, default %default')
+    parser.add_option('--record', metavar='DIR',
+                      help='record every session to DIR as asciicast v2 files (play with "asciinema play")')
+    parser.add_option('--record-max-size', type='int', default=SSHGO.record_max_size >> 20, metavar='MB',
+                      help='start a new recording file when the current one reaches MB megabytes, default %default')
+    parser.add_option('--record-keep', type='int', default=SSHGO.record_keep,
+                      help='recording files kept per session, older ones are deleted, default %default')
+    parser.add_option('--secrets', metavar='FILE',
+                      help='secret store referenced as ${secret:NAME} in expect, default ~/.config/sshgo/secrets.json')
+    parser.add_option('--agent-ttl', type='int', default=3600,
+                      help='seconds "secret unlock" keeps the store unlocked, default %default')
+    parser.add_option('--no-state', action='store_true', default=False,
+                      help='do not restore expanded groups, cursor and last search from the previous run, '
+                           'nor save them on exit')
+    parser.add_option('--render-stats', action='store_true', default=False,
+                      help='print cells/bytes written per frame on exit')
+    parser.add_option('--profile-startup', action='store_true', default=False,
+                      help='print the time spent in each startup phase on exit')
     options, args = parser.parse_args(sys.argv)
+    if options.command is None and len(args) > 1 and args[1] == 'stats':
+        print_login_stats(args[2:])
+        return
+    secrets_file = os.path.expanduser(options.secrets) if options.secrets is not None else secrets_file_default()
+    if options.command is None and len(args) > 1 and args[1] == 'secret':
+        try:
+            secret_command(args[2:], secrets_file, max(options.agent_ttl, 1))
+        except ConfigError as e:
+            print('\033[1;31;40m %s\033[0m' % e)
+            sys.exit(1)
+        return
     host_file = os.path.expanduser(sshHosts)
 
     if options.config is not None:
@@ -566,4 +3295,94 @@ if __name__ == '__main__':
         fp = open(host_file, 'w')
         fp.close()
 
-    SSHGO(host_file)
+    if options.completion_script is not None:
+        print_completion_script(parser, options.completion_script)
+        return
+    if options.complete is not None or options.complete_index or options.complete_daemon:
+        try:
+            if options.complete_daemon:
+                CompletionDaemon(host_file, not options.no_cache).serve()
+            elif options.complete_index:
+                print(ensure_completion_index(host_file, not options.no_cache))
+            else:
+                try:
+                    lines = query_completion_daemon(completion_index_for(host_file) + '.sock', options.complete)
+                except OSError:
+                    lines = complete_prefix(read_completion_index(ensure_completion_index(host_file,
+                                                                                          not options.no_cache)),
+                                            options.complete)
+                for line in lines:
+                    print(line)
+        except ConfigError as e:
+            print('\033[1;31;40m %s\033[0m' % e)
+            sys.exit(1)
+        return
+
+    sshgo = SSHGO(host_file, options.search_mode, not options.no_cache, options.ssh_command,
+                  not options.no_multiplex, options.control_persist, max(min(options.recent, 10), 0))
+    sshgo.batch_parallel = max(options.parallel, 1)
+    sshgo.batch_timeout = options.timeout
+    sshgo.probe_ttl = options.probe_ttl
+    sshgo.reload_interval = max(options.reload_interval, 0)
+    if options.record is not None:
+        sshgo.record_dir = os.path.expanduser(options.record)
+        sshgo.record_max_size = max(options.record_max_size, 1) << 20
+        sshgo.record_keep = options.record_keep
+    sshgo.secrets_file = secrets_file
+    sshgo.persist_state = not options.no_state
+    sshgo.login_step_timeout = options.step_timeout
+    sshgo.login_timeout = options.login_timeout
+    sshgo.trace_login = options.trace_login
+    if options.show_connect_time:
+        sshgo.load_last_connect()
+    sshgo.probe_banner = options.probe_banner
+    if options.command is not None:
+        try:
+            nodes = [sshgo.find_node(title) for title in args[1:]] if len(args) > 1 else sshgo.config
+            failed = sshgo.run_batch(nodes, options.command)
+        except ConfigError as e:
+            print('\033[1;31;40m %s\033[0m' % e)
+            sys.exit(1)
+        sys.exit(1 if failed else 0)
+    if options.list or options.json or len(args) > 1:
+        # 不启动界面: 列出匹配的主机，或者只有一个匹配时直接登录
+        try:
+            if len(args) > 1:
+                hosts = sshgo.match_hosts(' '.join(args[1:]))
+            else:
+                hosts = [leaf for node in sshgo.config for leaf in sshgo._leaves_under(node)]
+            if options.json:
+                print(json.dumps([{'title': node.title, 'ssh': node.ssh, 'pre_host': node.pre_host,
+                                   'group': sshgo.host_path(node)} for node in hosts], ensure_ascii=False, indent=2))
+            elif options.list:
+                for node in hosts:
+                    print(node.title)
+            elif len(hosts) == 1:
+                sshgo.do_ssh(hosts[0])
+            else:
+                sys.stderr.write('%d hosts match "%s"%s\n' % (len(hosts), ' '.join(args[1:]), ':' if len(hosts) else ''))
+                for node in hosts[:20]:
+                    sys.stderr.write('  %s\n' % node.title)
+                sys.exit(1)
+        except ConfigError as e:
+            print('\033[1;31;40m %s\033[0m' % e)
+            sys.exit(1)
+        return
+    if options.probe:
+        sshgo.start_probe()
+    sshgo.start()
+    sshgo.restore_screen()
+    if options.render_stats:
+        render_stats = sshgo.render_stats
+        frames = max(render_stats['frames'], 1)
+        print('frames: %d, cells: %d (%.1f/frame), bytes: %d (%.1f/frame)' % (
+            render_stats['frames'], render_stats['cells'], render_stats['cells'] / frames,
+            render_stats['bytes'], render_stats['bytes'] / frames))
+    if options.profile_startup:
+        for phase, seconds in sshgo.startup_profile:
+            print('%-14s %8.2f ms' % (phase, seconds * 1000))
+        print('%-14s %8.2f ms' % ('total', sum(seconds for phase, seconds in sshgo.startup_profile) * 1000))
+
+
+if __name__ == '__main__':
+    main()
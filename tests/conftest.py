@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench  # noqa: E402
+import sshgo  # noqa: E402
+
+
+# 缓存、状态和密码库都写到临时目录里，不碰真实的 ~/.cache 和 ~/.config
+@pytest.fixture(autouse=True)
+def isolated_home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    return tmp_path
+
+
+# 写配置文件，每次把mtime往后推一秒，同一秒内连续修改也能被当成变化
+@pytest.fixture
+def write_config(tmp_path):
+    counter = [0]
+
+    def write(name, nodes):
+        path = tmp_path / name
+        with open(path, 'w') as f:
+            if name.endswith('.jsonl'):
+                f.write(''.join(json.dumps(node) + '\n' for node in nodes))
+            else:
+                json.dump(nodes, f)
+        counter[0] += 1
+        mtime = os.stat(path).st_mtime + counter[0]
+        os.utime(path, (mtime, mtime))
+        return str(path)
+
+    return write
+
+
+# 不需要终端的 SSHGO: 用 bench.py 里假的curses和屏幕
+@pytest.fixture
+def headless():
+    def make(config_file, lines=20, cols=80):
+        return bench.headless_app(config_file, bench.FakeScreen(lines, cols))
+
+    yield make
+    sshgo.curses = bench.sshgo_curses
@@ -0,0 +1,461 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+
+import sshgo
+from sshgo import ConfigError, Handshake, LoginTimeout, SecretStore
+
+
+HOSTS = [
+    {'title': 'web', 'expanded': True, 'sub_node': [
+        {'title': 'web1', 'ssh': 'root@10.0.0.1', 'expect': [{'passwd': 'pw1'}]},
+        {'title': 'web2', 'ssh': 'root@10.0.0.2'},
+    ]},
+    {'title': 'db', 'sub_node': [
+        {'title': 'jump', 'ssh': 'admin@jump', 'expect': [{'passwd': 'jpw'}]},
+        {'title': 'db1', 'pre_host': 'jump', 'expect': [{'# ': 'ssh db1'}, {'passwd': 'dbpw'}]},
+    ]},
+    {'title': 'team', 'include': 'team.jsonl'},
+]
+
+TEAM = [
+    {'header': {'title': 'team', 'count': 2}},
+    {'title': 't1', 'ssh': 't1'},
+    {'title': 'tgroup', 'sub_node': [{'title': 't2', 'ssh': 't2', 'pre_host': 'web1'}]},
+]
+
+
+@pytest.fixture
+def inventory(write_config):
+    write_config('team.jsonl', TEAM)
+    return write_config('hosts.json', HOSTS)
+
+
+def titles(nodes):
+    return [node.title for node in nodes]
+
+
+# 登录状态机
+
+def test_handshake_password_login():
+    handshake = Handshake([{'passwd': 'pw'}], title='web1')
+    assert handshake.feed('') == ([], [])
+    assert handshake.feed("root@10.0.0.1's password: ") == (['pw'], [])
+    assert handshake.state == 'done'
+    assert [timing[1] for timing in handshake.timings] == ['passwd']
+
+
+def test_handshake_accepts_new_host_key_before_password():
+    handshake = Handshake([{'passwd': 'pw'}])
+    replies, _ = handshake.feed("Are you sure you want to continue connecting (yes/no/[fingerprint])? ")
+    assert replies == ['yes']
+    assert handshake.state == 'login'
+    assert handshake.feed('password: ')[0] == ['pw']
+    assert handshake.state == 'done'
+
+
+def test_handshake_skips_password_when_key_auth_reaches_prompt():
+    handshake = Handshake([{'passwd': 'pw'}, {'$ ': 'cd /data'}])
+    replies, _ = handshake.feed('Last login: today\r\n[root@web1 ~]$ ')
+    assert replies == ['cd /data']
+    assert handshake.state == 'done'
+    assert [(timing[1], timing[3]) for timing in handshake.timings] == [('passwd', True), ('$ ', False)]
+
+
+def test_handshake_runs_command_and_collects_output():
+    handshake = Handshake([{'passwd': 'pw'}, {'ps1': ''}], 'uptime', 'web1')
+    assert len(handshake.steps) == 1  # ps1 只影响终端显示，批量执行时跳过
+    assert handshake.feed('password: ')[0] == ['pw']
+    replies, _ = handshake.feed('[root@web1 ~]# ')
+    assert len(replies) == 1 and 'uptime' in replies[0]
+    assert handshake.state == 'begin'
+    replies, lines = handshake.feed(replies[0] + '\r\n__SSHGO_BEGIN\r\n 10:00 up 3 days\r\nsecond')
+    assert (replies, lines, handshake.state) == ([], [' 10:00 up 3 days'], 'running')
+    replies, lines = handshake.feed(' line\r\n__SSHGO_RC=3\r\n')
+    assert (replies, lines) == (['exit'], ['second line'])
+    assert handshake.exit_code == 3
+    assert handshake.state == 'done'
+
+
+def test_handshake_deadline():
+    handshake = Handshake([{'passwd': 'pw'}], title='web1', step_timeout=5, total_timeout=60)
+    handshake.check_deadline(handshake.started + 4)
+    with pytest.raises(LoginTimeout, match='web1|passwd'):
+        handshake.check_deadline(handshake.started + 6)
+
+
+def test_login_steps_follow_pre_host_chain(inventory):
+    app = sshgo.SSHGO(inventory, use_cache=False, multiplex=False, recent_size=0)
+    node = app.title_index['db1']
+    begin_node, expect_list = app.login_steps(node)
+    assert begin_node.title == 'jump'
+    assert expect_list == [{'passwd': 'jpw'}, {'# ': 'ssh db1'}, {'passwd': 'dbpw'}]
+    owners = app._expect_owners(node)
+    handshake = Handshake(expect_list, None, node.title, owners=owners)
+    assert [step[:2] for step in handshake.steps] == [('jump', 'passwd'), ('db1', '# '), ('db1', 'passwd')]
+
+
+# 批量执行: 用 fake_ssh.py 代替ssh
+
+FAKE_SSH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fake_ssh.py')
+
+
+@pytest.fixture
+def batch(write_config):
+    def run(hosts, command, titles=None, **settings):
+        app = sshgo.SSHGO(write_config('batch.json', hosts), use_cache=False, multiplex=False, recent_size=0,
+                          ssh_command='%s %s' % (sys.executable, FAKE_SSH))
+        for name, value in settings.items():
+            setattr(app, name, value)
+        out = io.StringIO()
+        nodes = app.config if titles is None else [app.title_index[title] for title in titles]
+        failed = app.run_batch(nodes, command, out)
+        output, _, table = out.getvalue().partition('\n\n')
+        summary = dict((line.split()[0], tuple(line.split()[1:3])) for line in table.splitlines()[1:-1])
+        return failed, output.splitlines(), summary
+
+    return run
+
+
+def test_batch_collects_output_and_exit_codes(batch):
+    hosts = [{'title': 'ok', 'ssh': 'root@ok', 'expect': [{'passwd': 'pw'}]},
+             {'title': 'denied', 'ssh': '--password other root@denied', 'expect': [{'passwd': 'pw'}]}]
+    failed, lines, summary = batch(hosts, 'echo hello')
+    assert failed == 1
+    assert 'ok     | hello' in lines
+    assert summary == {'ok': ('ok', '0'), 'denied': ('error', '-')}
+
+    failed, lines, summary = batch(hosts[:1], 'echo bye; (exit 3)')
+    assert failed == 1
+    assert lines == ['ok | bye']
+    assert summary == {'ok': ('fail', '3')}
+
+
+def test_batch_accepts_new_host_key(batch):
+    hosts = [{'title': 'new', 'ssh': '--host-key root@new', 'expect': [{'passwd': 'pw'}]}]
+    failed, lines, summary = batch(hosts, 'echo $((6 * 7))')
+    assert failed == 0
+    assert lines == ['new | 42']
+    assert summary == {'new': ('ok', '0')}
+
+
+def test_batch_times_out_slow_host_only(batch):
+    hosts = [{'title': 'slow', 'ssh': '--delay 5 root@slow', 'expect': [{'passwd': 'pw'}]},
+             {'title': 'fast', 'ssh': 'root@fast', 'expect': [{'passwd': 'pw'}]}]
+    failed, lines, summary = batch(hosts, 'echo hello', batch_timeout=0.5)
+    assert failed == 1
+    assert 'fast | hello' in lines
+    assert any(line.startswith('slow | timeout waiting for "slow: passwd"') for line in lines)
+    assert summary == {'slow': ('timeout', '-'), 'fast': ('ok', '0')}
+
+
+def test_batch_logs_in_through_jump_host(batch):
+    hosts = [{'title': 'jump', 'ssh': 'admin@jump', 'expect': [{'passwd': 'pw'}]},
+             {'title': 'inner', 'pre_host': 'jump', 'expect': [{'$ ': 'ssh root@inner'}, {'passwd': 'pw'}]}]
+    failed, lines, summary = batch(hosts, 'echo inside', titles=['inner'])
+    assert failed == 0
+    assert lines == ['inner | inside']
+    assert summary == {'inner': ('ok', '0')}
+
+
+# include 的组延迟加载
+
+def test_include_is_loaded_on_demand(inventory):
+    app = sshgo.SSHGO(inventory, use_cache=False, multiplex=False, recent_size=0)
+    team = app.title_index['team']
+    assert team in app.unloaded_groups
+    assert 't1' not in app.title_index
+    assert team.count == 2
+    app.load_group(team)
+    assert not len(app.unloaded_groups)
+    assert titles(team.sub_node) == ['t1', 'tgroup']
+    assert app.title_index['t2'].parent is app.title_index['tgroup']
+    assert app.title_index['t2'].level == 2
+    assert app.login_steps(app.title_index['t2'])[0].title == 'web1'
+
+
+def test_broken_include_raises_config_error(inventory, tmp_path):
+    with open(tmp_path / 'team.jsonl', 'w') as f:
+        f.write('{"title": "t1", \n')
+    app = sshgo.SSHGO(inventory, use_cache=False, multiplex=False, recent_size=0)
+    team = app.title_index['team']
+    with pytest.raises(ConfigError, match='team'):
+        app.load_group(team)
+    assert team in app.unloaded_groups
+
+
+def test_include_with_error_mid_file_can_be_retried(inventory, tmp_path, write_config):
+    with open(tmp_path / 'team.jsonl', 'w') as f:
+        f.write('{"title": "t1", "ssh": "t1"}\n{"title": "t3", "ssh": "t3", "pre_host": "web1"}\n{"title": \n')
+    app = sshgo.SSHGO(inventory, use_cache=False, multiplex=False, recent_size=0)
+    team = app.title_index['team']
+    line_number = app.line_number
+    with pytest.raises(ConfigError, match='team'):
+        app.load_group(team)
+    assert 't1' not in app.title_index and 't3' not in app.title_index
+    assert 'web1' not in app.pre_host_list
+    assert team in app.unloaded_groups and not len(team.sub_node)
+    assert app.line_number == line_number
+    write_config('team.jsonl', TEAM)
+    app.load_group(team)
+    assert titles(team.sub_node) == ['t1', 'tgroup']
+    assert app.title_index['t1'].parent is team
+    assert 'web1' in app.pre_host_list
+
+
+def test_include_with_duplicate_title_is_not_registered(inventory, write_config):
+    write_config('team.jsonl', [{'title': 't1', 'ssh': 't1'}, {'title': 'web2', 'ssh': 'other'}])
+    app = sshgo.SSHGO(inventory, use_cache=False, multiplex=False, recent_size=0)
+    with pytest.raises(ConfigError, match='web2'):
+        app.load_group(app.title_index['team'])
+    assert 't1' not in app.title_index
+    assert app.title_index['web2'].ssh == 'root@10.0.0.2'
+
+
+def test_match_hosts_loads_includes(inventory):
+    app = sshgo.SSHGO(inventory, use_cache=False, multiplex=False, recent_size=0)
+    assert titles(app.match_hosts('t2')) == ['t2']
+    assert not len(app.unloaded_groups)
+
+
+# 编译缓存
+
+def test_inventory_cache_round_trip(inventory):
+    first = sshgo.SSHGO(inventory, use_cache=True, multiplex=False, recent_size=0)
+    assert os.path.exists(sshgo.cache_file_for(inventory, 'inventory'))
+    second = sshgo.SSHGO(inventory, use_cache=True, multiplex=False, recent_size=0)
+    assert 'cache load' in [phase for phase, seconds in second.startup_profile]
+    for title, node in first.title_index.items():
+        cached = second.title_index[title]
+        assert (cached.ssh, cached.pre_host, cached.expect, cached.level, cached.line_number, cached.is_group) == \
+               (node.ssh, node.pre_host, node.expect, node.level, node.line_number, node.is_group)
+        assert (cached.parent and cached.parent.title) == (node.parent and node.parent.title)
+    assert titles(second.visible) == titles(first.visible)
+    assert titles(second.unloaded_groups) == ['team']
+    second.load_group(second.title_index['team'])
+    assert 't2' in second.title_index
+
+
+def test_inventory_cache_invalidated_by_edit(inventory, write_config):
+    sshgo.SSHGO(inventory, use_cache=True, multiplex=False, recent_size=0)
+    write_config('hosts.json', HOSTS)  # 只改了mtime，内容相同时缓存依然可用
+    app = sshgo.SSHGO(inventory, use_cache=True, multiplex=False, recent_size=0)
+    assert 'cache load' in [phase for phase, seconds in app.startup_profile]
+    hosts = json.loads(json.dumps(HOSTS))
+    hosts[0]['sub_node'].append({'title': 'web3', 'ssh': 'root@10.0.0.3'})
+    write_config('hosts.json', hosts)
+    app = sshgo.SSHGO(inventory, use_cache=True, multiplex=False, recent_size=0)
+    assert 'cache load' not in [phase for phase, seconds in app.startup_profile]
+    assert 'web3' in app.title_index
+
+
+# 搜索
+
+def test_substring_search_with_and_without_trigram_index(inventory, headless):
+    app = headless(inventory)
+    app.search_mode = 'substring'
+    app.search_keyword = 'db/'
+    app._build_search_index()
+    app._trigram_thread.join()
+    assert app._search_trigrams is not None
+    assert titles(app._search_node()) == ['jump', 'db1']
+    app._search_trigrams = None  # 后台线程还没建好索引时逐个比较
+    app._search_cache = None
+    assert titles(app._search_node()) == ['jump', 'db1']
+    texts = app._search_texts
+    app._build_search_index()
+    app._trigram_thread.join()
+    trigrams = app._search_trigrams
+    app._build_trigram_index(texts)  # 重新加载前开始建立的索引不会覆盖新的
+    assert app._search_trigrams is trigrams
+
+
+# 配置文件修改后的重新加载
+
+def test_reload_reuses_unchanged_nodes(inventory, write_config, headless):
+    app = headless(inventory)
+    web, web1, web2 = (app.title_index[title] for title in ('web', 'web1', 'web2'))
+    hosts = json.loads(json.dumps(HOSTS))
+    hosts[0]['sub_node'][1]['ssh'] = 'root@10.0.0.20'
+    hosts[0]['sub_node'].insert(0, {'title': 'web0', 'ssh': 'root@10.0.0.10'})
+    write_config('hosts.json', hosts)
+    assert app.reload_config()
+    assert app.title_index['web'] is web
+    assert app.title_index['web1'] is web1
+    assert app.title_index['web2'] is not web2
+    assert app.title_index['web2'].ssh == 'root@10.0.0.20'
+    assert titles(app.visible) == ['web', 'web0', 'web1', 'web2', 'db', 'team']
+    assert [node.line_number for node in app.visible[:4]] == [1, 2, 3, 4]
+    assert not app.reload_config()  # 没有变化
+
+
+def test_reload_keeps_old_tree_on_error(inventory, tmp_path, headless):
+    app = headless(inventory)
+    visible = list(app.visible)
+    with open(tmp_path / 'hosts.json', 'w') as f:
+        f.write('[{"title": ')
+    assert not app.reload_config()
+    assert app.status_message.startswith('reload failed')
+    assert app.visible == visible
+    assert 'web1' in app.title_index
+
+
+def test_reload_follows_cursor_to_moved_host(inventory, write_config, headless):
+    app = headless(inventory)
+    app.move_to(titles(app.visible).index('web2'))
+    hosts = json.loads(json.dumps(HOSTS))
+    hosts[1]['sub_node'].append(hosts[0]['sub_node'].pop())
+    write_config('hosts.json', hosts)
+    assert app.reload_config()
+    node = app.visible[app.current_row()]
+    assert node.title == 'web2'
+    assert node.parent.title == 'db'
+    assert app.title_index['db'].expanded
+
+
+def test_reload_moves_cursor_to_parent_of_deleted_host(inventory, write_config, headless):
+    app = headless(inventory)
+    app.move_to(titles(app.visible).index('web2'))
+    hosts = json.loads(json.dumps(HOSTS))
+    del hosts[0]['sub_node'][1]
+    write_config('hosts.json', hosts)
+    assert app.reload_config()
+    assert app.visible[app.current_row()].title == 'web'
+
+
+def test_reload_of_changed_include(inventory, write_config, headless):
+    app = headless(inventory)
+    app.load_group(app.title_index['team'])
+    t1 = app.title_index['t1']
+    write_config('team.jsonl', TEAM[:2] + [{'title': 't3', 'ssh': 't3'}])
+    assert app.reload_config()
+    assert app.title_index['t1'] is t1
+    assert 't3' in app.title_index and 't2' not in app.title_index
+
+
+# 密码库
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(SecretStore, 'scrypt_n', 1 << 4)  # 测试里不需要真的很慢的scrypt
+    store = SecretStore(str(tmp_path / 'config' / 'sshgo' / 'secrets.json'))
+    store.init('master')
+    store.set('db', 'p@ss 中文')
+    store.save()
+    return store
+
+
+def test_secret_store_round_trip(store):
+    assert oct(os.stat(store.path).st_mode & 0o777) == '0o600'
+    with open(store.path) as f:
+        assert 'p@ss' not in f.read()
+    loaded = SecretStore(store.path).load()
+    loaded.unlock('master')
+    assert loaded.get('db') == 'p@ss 中文'
+    with pytest.raises(ConfigError, match='not found'):
+        loaded.get('missing')
+    loaded.remove('db')
+    with pytest.raises(ConfigError, match='not found'):
+        loaded.remove('db')
+
+
+def test_secret_store_rejects_wrong_password(store):
+    loaded = SecretStore(store.path).load()
+    with pytest.raises(ConfigError, match='wrong master password'):
+        loaded.unlock('guess')
+
+
+def test_secret_store_detects_tampering(store):
+    with open(store.path) as f:
+        data = json.load(f)
+    data['secrets']['other'] = data['secrets']['db']  # 换了名字的密文也验证不过
+    with open(store.path, 'w') as f:
+        json.dump(data, f)
+    loaded = SecretStore(store.path).load()
+    loaded.unlock('master')
+    with pytest.raises(ConfigError, match='failed verification'):
+        loaded.get('other')
+
+
+def test_secret_store_missing_or_corrupted(tmp_path):
+    with pytest.raises(ConfigError, match='secret init'):
+        SecretStore(str(tmp_path / 'none.json')).load()
+    (tmp_path / 'bad.json').write_text('{}')
+    with pytest.raises(ConfigError, match='corrupted'):
+        SecretStore(str(tmp_path / 'bad.json')).load()
+
+
+def test_resolve_secrets_without_agent(store, write_config, monkeypatch):
+    import getpass
+    config = write_config('secret_hosts.json', [{'title': 'db', 'ssh': 'db', 'expect': [{'passwd': '${secret:db}'}]}])
+    app = sshgo.SSHGO(config, use_cache=False, multiplex=False, recent_size=0)
+    app.secrets_file = store.path
+    node = app.title_index['db']
+    with pytest.raises(ConfigError, match='locked'):
+        app.resolve_secrets(node.expect, {}, interactive=False)
+    monkeypatch.setattr(getpass, 'getpass', lambda prompt: 'master')
+    owners = app._expect_owners(node)
+    assert app.resolve_secrets(node.expect, owners) == [{'passwd': 'p@ss 中文'}]
+    assert node.expect == ({'passwd': '${secret:db}'},)  # 配置里的节点不变，明文不会进缓存
+
+
+# 界面状态的保存和恢复
+
+def test_state_round_trip(inventory, headless):
+    app = headless(inventory)
+    app.toggle_node()  # 折叠 web
+    app.move_to(titles(app.visible).index('db'))
+    app.toggle_node()  # 展开 db
+    app.move_to(titles(app.visible).index('db1'))
+    app.last_search = ('regex', 'web')
+    app.save_state()
+
+    restored = headless(inventory)
+    restored.restore_state()
+    assert titles(restored.visible) == ['web', 'db', 'jump', 'db1', 'team']
+    assert restored.visible[restored.current_row()].title == 'db1'
+    assert restored.last_search == ('regex', 'web')
+
+
+def test_state_restores_include_groups_and_survives_edits(inventory, write_config, headless):
+    app = headless(inventory)
+    app.move_to(titles(app.visible).index('team'))
+    app.toggle_node()
+    app.move_to(titles(app.visible).index('tgroup'))
+    app.toggle_node()
+    app.move_to(titles(app.visible).index('t2'))
+    app.save_state()
+
+    hosts = json.loads(json.dumps(HOSTS))
+    del hosts[1]  # 删掉了一个组，保存的其他状态依然能对上
+    write_config('hosts.json', hosts)
+    restored = headless(inventory)
+    restored.restore_state()
+    assert titles(restored.visible) == ['web', 'web1', 'web2', 'team', 't1', 'tgroup', 't2']
+    assert restored.visible[restored.current_row()].title == 't2'
+
+
+def test_state_keeps_nested_group_collapsed(write_config, headless):
+    config = write_config('nested.json', [{'title': 'outer', 'sub_node': [
+        {'title': 'inner', 'expanded': True, 'sub_node': [{'title': 'h', 'ssh': 'h'}]}]}])
+    app = headless(config)
+    app.toggle_node()  # 展开 outer
+    app.move_to(titles(app.visible).index('inner'))
+    app.toggle_node()  # 折叠配置里默认展开的 inner
+    app.save_state()
+
+    restored = headless(config)
+    restored.restore_state()
+    assert titles(restored.visible) == ['outer', 'inner']
+    assert not restored.title_index['inner'].expanded
+
+
+def test_state_ignores_corrupted_file(inventory, headless):
+    app = headless(inventory)
+    with open(app.state_file(), 'w') as f:
+        f.write('not json')
+    app.restore_state()
+    assert titles(app.visible) == ['web', 'web1', 'web2', 'db', 'team']